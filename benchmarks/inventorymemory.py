@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+'''
+Measure memory per indexed object and transfer size per object for a
+VM inventory held in an inventory.Collection: full objects, objects
+projected to Nsx_object.lookupFields with included_fields, and the same
+projection stored as compact inventory.Record entries.
+
+Run from the repository root:
+    python benchmarks/inventorymemory.py --objects 100000
+'''
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import inventory
+import nsxobjects
+
+
+def virtualMachine(i):
+    '''
+    A VM as returned by a policy search, including the status blob
+    '''
+    return {
+        'resource_type': 'VirtualMachine',
+        'id': '5012%04x-%04x-%04x-%04x-%012x' % (i % 65536, i % 4096, i % 256, i % 16, i),
+        'display_name': 'vm-%06d' % i,
+        'path': '/infra/realized-state/enforcement-points/default/virtual-machines/vm-%06d' % i,
+        'external_id': '5012%04x-%04x-%04x-%04x-%012x' % (i % 65536, i % 4096, i % 256, i % 16, i),
+        'host_id': 'host-%05d' % (i % 2000),
+        'power_state': 'VM_RUNNING',
+        'type': 'REGULAR',
+        'local_id_on_host': '%d' % i,
+        'compute_ids': ['moIdOnHost:%d' % i, 'hostLocalId:%d' % i,
+                        'locationId:564d%08x' % i, 'instanceUuid:5012%08x' % i,
+                        'biosUuid:4212%08x' % i],
+        'guest_info': {'os_name': 'Ubuntu Linux (64-bit)',
+                       'computer_name': 'vm-%06d.corp.example.com' % i},
+        'source': {'target_id': 'cm-1', 'target_display_name': 'vcenter-1',
+                   'target_type': 'ComputeManager', 'is_valid': True},
+        'tags': [{'scope': 'app', 'tag': 'web'}, {'scope': 'env', 'tag': 'prod'}],
+        'status': {'consolidated_status': {'consolidated_status': 'SUCCESS'},
+                   'alarms': [], 'pending_changes_flag': False},
+        '_last_sync_time': 1700000000000 + i,
+        '_last_modified_time': 1700000000000 + i,
+        '_revision': i % 7,
+        '_protection': 'NOT_PROTECTED',
+    }
+
+
+def project(obj, fields):
+    return dict((f, obj[f]) for f in fields if f in obj)
+
+
+def measure(name, objects, transfer):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    c = inventory.Collection(api='/policy/api/v1/search/query?query=resource_type:VirtualMachine')
+    for o in objects():
+        c.add(o)
+    c.index('display_name')
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    kinds = set(type(o).__name__ for o in c.objects)
+    print("%-22s %10.0f %12.0f   %s" % (name, used/len(c.objects), transfer, ','.join(kinds)))
+    return used
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=100000)
+    args = parser.parse_args()
+    n = args.objects
+    fields = nsxobjects.Nsx_object.lookupFields
+
+    full = len(json.dumps(virtualMachine(1)))
+    projected = len(json.dumps(project(virtualMachine(1), fields)))
+
+    print("%d objects" % n)
+    print("%-22s %10s %12s   %s" % ("", "bytes/obj", "JSON bytes/obj", "entries"))
+    a = measure('full object', lambda: (virtualMachine(i) for i in range(n)), full)
+    # keep projected objects as plain dicts to show what Record saves
+    saved = inventory.Record.fields
+    inventory.Record.fields = frozenset()
+    try:
+        measure('projected dict', lambda: (project(virtualMachine(i), fields)
+                                           for i in range(n)), projected)
+    finally:
+        inventory.Record.fields = saved
+    b = measure('projected Record', lambda: (project(virtualMachine(i), fields)
+                                             for i in range(n)), projected)
+    print("memory %.1fx smaller, transfer %.1fx smaller" % (a/float(b), full/float(projected)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+'''
+Compare the JSON codecs available to NsxConnect on NSX shaped payloads:
+a page of realized VirtualMachine objects and a page of SegmentPort
+search results.  orjson is only measured when it's installed.
+
+Run from the repository root:
+    python benchmarks/jsoncodecs.py --objects 5000 --runs 10
+'''
+import argparse
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import connections
+
+
+def vmPage(count):
+    results = []
+    for i in range(count):
+        vmid = str(uuid.UUID(int=i))
+        results.append({
+            'resource_type': 'VirtualMachine',
+            'display_name': 'app-%05d' % i,
+            'external_id': vmid,
+            'host_id': str(uuid.UUID(int=i % 64)),
+            'power_state': 'VM_RUNNING',
+            'type': 'REGULAR',
+            'local_id_on_host': str(i),
+            'compute_ids': ['moIdOnHost:%d' % i, 'hostLocalId:%d' % i,
+                            'locationId:%s' % vmid, 'instanceUuid:%s' % vmid,
+                            'biosUuid:%s' % vmid, 'vmUuid:%s' % vmid],
+            'guest_info': {'os_name': 'Ubuntu Linux (64-bit)',
+                           'computer_name': 'app-%05d' % i},
+            'source': {'target_id': str(uuid.UUID(int=1)),
+                       'target_display_name': 'vcenter.corp.local',
+                       'target_type': 'ComputeManager',
+                       'is_valid': True},
+            'tags': [{'scope': 'tier', 'tag': 'app'},
+                     {'scope': 'env', 'tag': 'prod'}],
+            '_last_sync_time': 1700000000000 + i,
+        })
+    return {'results': results, 'result_count': count, 'sort_by': 'display_name',
+            'sort_ascending': True, 'cursor': str(count)}
+
+
+def portPage(count):
+    results = []
+    for i in range(count):
+        seg = 'seg-%03d' % (i % 200)
+        results.append({
+            'resource_type': 'SegmentPort',
+            'id': 'port-%06d' % i,
+            'display_name': 'app-%05d.vmx@%s' % (i, uuid.UUID(int=i)),
+            'path': '/infra/segments/%s/ports/port-%06d' % (seg, i),
+            'relative_path': 'port-%06d' % i,
+            'parent_path': '/infra/segments/%s' % seg,
+            'unique_id': str(uuid.UUID(int=i)),
+            'attachment': {'id': str(uuid.UUID(int=i + 1)), 'traffic_tag': 0,
+                           'hyperbus_mode': 'DISABLE'},
+            'admin_state': 'UP',
+            'address_bindings': [],
+            'marked_for_delete': False,
+            'overridden': False,
+            '_create_time': 1700000000000 + i,
+            '_last_modified_time': 1700000000000 + i,
+            '_create_user': 'system',
+            '_last_modified_user': 'system',
+            '_protection': 'NOT_PROTECTED',
+            '_revision': 0,
+            'status': {'consolidated_status': {'consolidated_status': 'SUCCESS'}},
+        })
+    return {'results': results, 'result_count': count, 'cursor': str(count)}
+
+
+def measure(func, arg, runs):
+    best = None
+    for i in range(runs):
+        start = time.perf_counter()
+        func(arg)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--objects', type=int, default=5000,
+                        help='Objects per page')
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    codecs = [connections.JsonCodec()]
+    if connections.orjson:
+        codecs.append(connections.OrjsonCodec())
+    else:
+        print("orjson not installed, measuring the standard library only")
+
+    print("%-12s %-8s %10s %12s %12s" % ("payload", "codec", "MB", "loads ms", "dumps ms"))
+    for name, page in [('vms', vmPage(args.objects)),
+                       ('ports', portPage(args.objects))]:
+        body = connections.JsonCodec().dumps(page)
+        for c in codecs:
+            loads = measure(c.loads, body, args.runs)
+            dumps = measure(c.dumps, page, args.runs)
+            print("%-12s %-8s %10.2f %12.1f %12.1f" % (name, c.name, len(body)/1e6,
+                                                      loads*1000, dumps*1000))
+
+
+if __name__ == '__main__':
+    main()
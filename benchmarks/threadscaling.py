@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+'''
+Measure NsxConnect GET throughput from 1 to 64 worker threads against a
+local stand-in server that answers every request with a small JSON body
+after a simulated manager latency.
+
+Run from the repository root:
+    python benchmarks/threadscaling.py --latency 20 --requests 512
+'''
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import connections
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # buffer headers and body into one write to avoid Nagle/delayed ACK stalls
+    wbufsize = -1
+    latency = 0.0
+    body = json.dumps({'results': [{'id': 'x', 'display_name': 'x',
+                                    'path': '/infra/segments/x'}],
+                       'result_count': 1}).encode()
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    request_queue_size = 256
+
+
+def startServer(latency):
+    StandInHandler.latency = latency
+    httpd = StandInServer(('127.0.0.1', 0), StandInHandler)
+    httpd.daemon_threads = True
+    t = threading.Thread(target=httpd.serve_forever, daemon=True)
+    t.start()
+    return httpd
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=20,
+                        help='Simulated server latency in ms')
+    parser.add_argument('--requests', type=int, default=512,
+                        help='Number of GET requests per run')
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8, 16, 32, 64])
+    args = parser.parse_args()
+
+    httpd = startServer(latency=args.latency/1000.0)
+    port = httpd.server_address[1]
+
+    print("%8s %10s %12s %10s" % ("workers", "seconds", "requests/s", "speedup"))
+    base = None
+    for w in args.workers:
+        mp = connections.NsxConnect(server='127.0.0.1', port=port, password='x',
+                                    isNsx=False, poolMaxsize=w)
+        # the stand-in server speaks plain http
+        mp.server = 'http://127.0.0.1:%d' % port
+        apis = ['/api/v1/transport-nodes/%d/state' % i for i in range(args.requests)]
+        start = time.time()
+        results = mp.mapGet(apis=apis, maxWorkers=w)
+        elapsed = time.time() - start
+        errors = [r for r in results if isinstance(r, Exception)]
+        rate = args.requests / elapsed
+        if not base:
+            base = rate
+        print("%8d %10.2f %12.1f %9.1fx%s" % (w, elapsed, rate, rate/base,
+                                              ' (%d errors)' % len(errors) if errors else ''))
+    httpd.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -5,8 +5,574 @@ from requests.structures import CaseInsensitiveDict
 import base64
 import json
 import copy
+import ssl
+import concurrent.futures
+import threading
+import asyncio
+import collections
+import time
+import random
+import datetime
+import email.utils
+import codecs
+from inventory import Inventory, DiskCache
+from hapi import HapiBatch
+import os
 from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+class JsonCodec(object):
+    '''
+    Standard library JSON codec.  loads() takes bytes or str,
+    dumps() returns bytes ready to be sent as a request body
+    '''
+    name = 'json'
+    def loads(self, data):
+        return json.loads(data)
+    def dumps(self, obj):
+        return json.dumps(obj).encode()
+    def pretty(self, obj, indent=4):
+        return json.dumps(obj, indent=indent)
+
+class OrjsonCodec(JsonCodec):
+    '''
+    orjson based codec, several times faster than the standard library on
+    large list responses.  pretty() is inherited so printed output is the
+    same with either codec
+    '''
+    name = 'orjson'
+    def loads(self, data):
+        return orjson.loads(data)
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+def getCodec(name=None):
+    '''
+    Returns the codec called name ('json' or 'orjson'), by default
+    orjson when it's installed and the standard library otherwise
+    '''
+    if name == 'json':
+        return JsonCodec()
+    if name == 'orjson' or (not name and orjson):
+        if not orjson:
+            raise ImportError("orjson codec requested but orjson is not installed")
+        return OrjsonCodec()
+    return JsonCodec()
+
+# Minimum NSX version, in the major/minor form returned by
+# NsxConnect.getVersion(), that provides an API capability
+CAPABILITIES = {
+    'policy': 24,               # /policy/api/v1
+    'hierarchical_api': 24,     # PATCH /policy/api/v1/infra with Child objects
+    'policy_search': 25,        # /policy/api/v1/search/query
+    'federation': 30,           # global-infra, global manager
+    'edge_rtep': 30,            # remote tunnel endpoints
+    'vds_host_switch': 30,      # VDS 7 host switches on transport nodes
+    'projects': 40,             # /orgs/<org>/projects/<project>
+    'vpc': 41,                  # VPCs within projects
+}
+
+# words in the body of a 403 caused by an expired or invalid session,
+# other 403s are permission errors
+SESSION_ERRORS = ('session', 'xsrf', 'csrf', 'expired', 'credentials')
+
+# seconds a new session is trusted, a 401/403 within them isn't its fault
+SESSION_MIN_AGE = 10
+
+def versionCapabilities(version):
+    '''
+    Returns the set of capability names available in version
+    '''
+    return set(c for c,v in CAPABILITIES.items() if version >= v)
+
+def writeCacheFile(filename, data):
+    '''
+    Atomically replace filename with the JSON encoded data
+    '''
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    fd = os.open(tmp, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as fp:
+        fp.write(json.dumps(data))
+    os.replace(tmp, filename)
+
+class ResultsDecoder(object):
+    '''
+    Incremental decoder for NSX list responses.  Feed it the body in chunks
+    of bytes and it returns the items of the top level "results" array as
+    soon as each one is complete, without holding the whole body.  After the
+    last chunk, envelope() returns the other top level fields (cursor,
+    result_count...) with an empty results list
+    '''
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.state = 'head'
+        self.head = None
+        self.tail = []
+        # scanner state for the head, before the results array
+        self.scanned = 0
+        self.depth = 0
+        self.inString = False
+        self.escape = False
+        self.lastString = None
+        self.stringStart = None
+        self.afterKey = None
+
+    def feed(self, chunk, final=False):
+        '''
+        Add a chunk of the body, returns the list of completed items
+        '''
+        self.buf += self.utf8.decode(chunk, final)
+        items = []
+        if self.state == 'head':
+            self.__scanHead()
+        if self.state == 'items':
+            self.__decodeItems(items, final)
+        if self.state == 'tail':
+            self.tail.append(self.buf[self.pos:])
+            self.buf = ''
+            self.pos = 0
+        elif self.state == 'items' and self.pos:
+            # drop the decoded items, the head has been saved
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        return items
+
+    def __scanHead(self):
+        # the head is kept whole in buf until the results array is found,
+        # scanning resumes where the previous chunk ended
+        buf = self.buf
+        i = self.scanned
+        while i < len(buf):
+            c = buf[i]
+            if self.inString:
+                if self.escape:
+                    self.escape = False
+                elif c == '\\':
+                    self.escape = True
+                elif c == '"':
+                    self.inString = False
+                    self.lastString = buf[self.stringStart:i]
+                    self.stringStart = None
+            elif c == '"':
+                self.inString = True
+                self.stringStart = i + 1
+            elif c in '{[':
+                if (c == '[' and self.depth == 1 and self.afterKey == 'results'):
+                    self.head = buf[:i+1]
+                    self.state = 'items'
+                    self.pos = i + 1
+                    return
+                self.depth += 1
+                self.afterKey = None
+            elif c in '}]':
+                self.depth -= 1
+            elif c == ':':
+                self.afterKey = self.lastString if self.depth == 1 else None
+            elif c == ',':
+                self.afterKey = None
+            i += 1
+        self.scanned = i
+
+    def __decodeItems(self, items, final):
+        buf = self.buf
+        pos = self.pos
+        n = len(buf)
+        while True:
+            while pos < n and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= n:
+                break
+            if buf[pos] == ']':
+                self.state = 'tail'
+                self.tail.append(']')
+                pos += 1
+                break
+            try:
+                item, end = self.decoder.raw_decode(buf, pos)
+            except ValueError:
+                # item not complete yet
+                break
+            if not final and (end >= n or buf[end] not in ' \t\r\n,]'):
+                # a number cut by the end of the chunk decodes too
+                break
+            items.append(item)
+            pos = end
+        self.pos = pos
+
+    def envelope(self):
+        '''
+        The top level fields of the response, results is an empty list
+        '''
+        if self.state == 'head':
+            # no results array, the whole body is the envelope
+            return json.loads(self.buf)
+        return json.loads(self.head + ''.join(self.tail))
+
+def cacheDir(*parts):
+    '''
+    Returns (and creates) a directory under the nsxapi cache directory,
+    $NSXAPI_CACHE_DIR or $XDG_CACHE_HOME/nsxapi, default ~/.cache/nsxapi
+    '''
+    base = os.environ.get('NSXAPI_CACHE_DIR')
+    if not base:
+        base = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                            os.path.expanduser('~/.cache'), 'nsxapi')
+    d = os.path.join(base, *parts)
+    os.makedirs(d, mode=0o700, exist_ok=True)
+    return d
+
+class TokenBucket(object):
+    '''
+    Thread safe token bucket, allows rate requests per second on average
+    with bursts of up to burst requests
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst) if burst else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        '''
+        Take a token if one is available, returns 0 if it was taken,
+        otherwise the seconds until there is one
+        '''
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        '''
+        Block until a token is available and take it
+        '''
+        wait = self.take()
+        while wait:
+            time.sleep(wait)
+            wait = self.take()
+
+    async def acquireAsync(self):
+        '''
+        Coroutine version of acquire()
+        '''
+        wait = self.take()
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self.take()
+
+class AdaptiveWindow(object):
+    '''
+    AIMD limit on the number of requests in flight, in the style of TCP
+    congestion control.  The window grows by one request per window of
+    successful responses while the p95 latency stays within tolerance of
+    the lowest p95 observed, and is halved on timeouts and throttling
+    responses.  Like TCP it's halved once per window: congestion reported
+    by requests started before the last decrease is ignored
+    '''
+    def __init__(self, initial=4, minimum=1, maximum=64, samples=200, tolerance=1.5):
+        self.window = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.inflight = 0
+        self.latencies = collections.deque(maxlen=samples)
+        self.baseline = None
+        self.increases = 0
+        self.decreases = 0
+        # sequence number of the last request started, and of the last
+        # one started before the window was halved
+        self.started = 0
+        self.recovered = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        '''
+        Block until the number of requests in flight is below the window,
+        returns the sequence number of the request to pass to release()
+        '''
+        with self.cond:
+            while self.inflight >= int(self.window):
+                self.cond.wait()
+            self.inflight += 1
+            self.started += 1
+            return self.started
+
+    def release(self, sequence=None, latency=None, congested=False):
+        '''
+        Return a slot to the window.  sequence is the value acquire()
+        returned, latency is the response time in seconds of a successful
+        request, congested is True for a timeout or a throttling response
+        '''
+        with self.cond:
+            self.inflight -= 1
+            if congested and sequence is not None and sequence <= self.recovered:
+                # sent at the old window, already accounted for
+                pass
+            elif congested:
+                self.window = max(self.minimum, self.window / 2)
+                self.decreases += 1
+                self.recovered = self.started
+                # let a new baseline form at the reduced load
+                self.latencies.clear()
+                self.baseline = None
+            elif latency is not None:
+                self.latencies.append(latency)
+                p95 = self.p95()
+                if p95 is None:
+                    grow = True
+                else:
+                    if self.baseline is None or p95 < self.baseline:
+                        self.baseline = p95
+                    grow = p95 <= self.baseline * self.tolerance
+                if grow and self.window < self.maximum:
+                    self.window = min(self.maximum, self.window + 1.0 / self.window)
+                    self.increases += 1
+            self.cond.notify_all()
+
+    def p95(self):
+        '''
+        p95 of the recent latency samples, None until there are enough samples
+        '''
+        if len(self.latencies) < 20:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def getStats(self):
+        with self.cond:
+            p95 = self.p95()
+            return {'window': int(self.window),
+                    'inflight': self.inflight,
+                    'minimum': self.minimum,
+                    'maximum': self.maximum,
+                    'p95_ms': round(p95 * 1000, 1) if p95 is not None else None,
+                    'baseline_p95_ms': round(self.baseline * 1000, 1) if self.baseline is not None else None,
+                    'increases': self.increases,
+                    'decreases': self.decreases}
+
+class SingleFlight(object):
+    '''
+    Concurrent calls of do() with the same key share one call of func,
+    the callers that arrive while it's running wait for its result or
+    exception.  A caller only joins a call started at or after its
+    generation, so it never gets a result older than its own writes
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, generation=0):
+        '''
+        Returns (result, shared), shared is True if another caller ran func
+        '''
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None or call['generation'] < generation
+            if leader:
+                # an older call keeps running for the callers that joined it
+                call = {'done': threading.Event(), 'generation': generation}
+                self.calls[key] = call
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result'], True
+        try:
+            call['result'] = func()
+        except BaseException as e:
+            call['error'] = e
+            raise
+        finally:
+            with self.lock:
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+            call['done'].set()
+        return call['result'], False
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    '''
+    Raised without contacting the server while its circuit breaker is open
+    '''
+    pass
+
+class CircuitBreaker(object):
+    '''
+    Circuit breaker for one manager.  Opens after threshold consecutive
+    connection errors or timeouts, calls then fail immediately with
+    CircuitOpenError.  After resetTimeout seconds one probe request is let
+    through (half-open), the breaker closes if it succeeds
+    '''
+    def __init__(self, server, threshold=5, resetTimeout=30):
+        self.server = server
+        self.threshold = threshold
+        self.resetTimeout = resetTimeout
+        self.state = 'closed'
+        self.failures = 0
+        self.trips = 0
+        self.rejected = 0
+        self.openedAt = 0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        '''
+        Raise CircuitOpenError if a request to the server must not be sent
+        '''
+        with self.lock:
+            if self.state == 'closed':
+                return
+            if (self.state == 'open' and
+                time.monotonic() - self.openedAt >= self.resetTimeout):
+                self.state = 'half-open'
+            if self.state == 'half-open' and not self.probing:
+                self.probing = True
+                return
+            self.rejected += 1
+            raise CircuitOpenError("Circuit breaker open for %s after %d consecutive failures"
+                                   %(self.server, self.failures))
+
+    def success(self):
+        with self.lock:
+            self.state = 'closed'
+            self.failures = 0
+            self.probing = False
+
+    def abort(self):
+        '''
+        The request let through by allow() failed for a reason that says
+        nothing about the server, another probe may be sent
+        '''
+        with self.lock:
+            self.probing = False
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                if self.state != 'open':
+                    self.trips += 1
+                self.state = 'open'
+                self.openedAt = time.monotonic()
+
+    def getStats(self):
+        with self.lock:
+            return {'state': self.state,
+                    'consecutive_failures': self.failures,
+                    'trips': self.trips,
+                    'rejected': self.rejected}
+
+class NodePool(object):
+    '''
+    Spreads read requests across the individual manager nodes of a cluster.
+    mode is 'round-robin' or 'least-latency'.  A node that fails is ejected
+    and re-admitted once a health probe succeeds, the probe is attempted
+    after retryInterval seconds, doubling on every failed probe
+    '''
+    def __init__(self, servers, mode='round-robin', retryInterval=10,
+                 maxInterval=300, probe=None):
+        self.mode = mode
+        self.retryInterval = retryInterval
+        self.maxInterval = maxInterval
+        self.probe = probe
+        self.nodes = collections.OrderedDict()
+        for server in servers:
+            self.nodes[server] = {'server': server, 'healthy': True,
+                                  'retryAt': 0, 'interval': retryInterval,
+                                  'probing': False, 'latency': None,
+                                  'requests': 0, 'failures': 0}
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def pick(self):
+        '''
+        Returns the server URL to send the next read to, None if no
+        node is currently healthy
+        '''
+        now = time.monotonic()
+        with self.lock:
+            for n in self.nodes.values():
+                if not n['healthy'] and not n['probing'] and now >= n['retryAt']:
+                    n['probing'] = True
+                    threading.Thread(target=self.__probe, args=(n['server'],),
+                                     daemon=True).start()
+            healthy = [n for n in self.nodes.values() if n['healthy']]
+            if not healthy:
+                return None
+            if self.mode == 'least-latency':
+                # nodes without a sample yet are tried first
+                node = min(healthy, key=lambda n: n['latency'] or 0)
+            else:
+                node = healthy[self.next % len(healthy)]
+                self.next += 1
+            node['requests'] += 1
+            return node['server']
+
+    def healthyCount(self):
+        with self.lock:
+            return len([n for n in self.nodes.values() if n['healthy']])
+
+    def report(self, server, latency=None, failed=False):
+        '''
+        Record the outcome of a request sent to server
+        '''
+        with self.lock:
+            n = self.nodes.get(server)
+            if not n:
+                return
+            if failed:
+                n['failures'] += 1
+                if n['healthy']:
+                    n['healthy'] = False
+                    n['retryAt'] = time.monotonic() + n['interval']
+            elif latency is not None:
+                # exponentially weighted moving average
+                if n['latency'] is None:
+                    n['latency'] = latency
+                else:
+                    n['latency'] = 0.8 * n['latency'] + 0.2 * latency
+
+    def __probe(self, server):
+        try:
+            ok = self.probe(server) if self.probe else True
+        except Exception:
+            ok = False
+        with self.lock:
+            n = self.nodes[server]
+            n['probing'] = False
+            if ok:
+                n['healthy'] = True
+                n['interval'] = self.retryInterval
+                n['latency'] = None
+            else:
+                n['interval'] = min(self.maxInterval, n['interval'] * 2)
+                n['retryAt'] = time.monotonic() + n['interval']
+
+    def getStats(self):
+        with self.lock:
+            return [{'server': n['server'],
+                     'healthy': n['healthy'],
+                     'latency_ms': round(n['latency'] * 1000, 1) if n['latency'] is not None else None,
+                     'requests': n['requests'],
+                     'failures': n['failures']}
+                    for n in self.nodes.values()]
 
 class NsxConnect(requests.Request):
     def __init__(self, server, port = 443,
@@ -14,7 +580,15 @@ class NsxConnect(requests.Request):
                  content='application/json', accept='application/json',
                  global_infra=False, global_gm=False, org='default',
                  site='default', enforcement='default', domain='default',
-                 cert=None, verify=False, timeout=None, project=None, isNsx=True):
+                 cert=None, verify=False, timeout=None, project=None, isNsx=True,
+                 poolConnections=10, poolMaxsize=10, poolBlock=False,
+                 keepalive=True, rate=None, burst=None, maxRetries=3,
+                 retryCodes=(429, 503), backoff=0.5, maxBackoff=30,
+                 adaptive=False, minWindow=1, maxWindow=64, readNodes=None,
+                 breakerThreshold=5, breakerReset=30,
+                 sessionAuth=False, sessionCache=False, versionTtl=None,
+                 codec=None, inventory=True, inventoryCache=False, inventoryTtl=0,
+                 singleFlight=True):
         '''
         server - The NSX Manager IP or FQDN
         port - TCP port for server
@@ -22,8 +596,55 @@ class NsxConnect(requests.Request):
         password - Password for the user, not required when re-using session
                    or cert auth
         cookie - Session cookiefile
-        
-        
+        poolConnections - number of per-host connection pools to cache
+        poolMaxsize - max connections kept per host
+        poolBlock - if True, block instead of opening extra connections
+                    when poolMaxsize is reached
+        keepalive - if False, close the connection after every request
+        rate - max requests per second sent to this manager, None for no limit
+        burst - number of requests that may be sent back to back before
+                rate applies, defaults to rate
+        maxRetries - number of times a request is retried when the
+                     response status is in retryCodes
+        retryCodes - status codes that are retried, NSX uses 429 and 503
+                     when client rate or concurrency limits are exceeded
+        backoff - base delay in seconds for exponential backoff,
+                  the Retry-After header is honored when present
+        maxBackoff - upper limit for a single backoff delay
+        adaptive - if True, the number of requests in flight is adjusted
+                   between minWindow and maxWindow from observed latency,
+                   timeouts and 429/503 responses.  See getStats()
+        readNodes - 'round-robin' or 'least-latency' to spread GET requests
+                    across the manager cluster nodes instead of server.
+                    Writes are always sent to server
+        breakerThreshold - consecutive connection errors or timeouts after
+                    which requests to a server fail immediately, None to
+                    disable.  Reads fail over to other nodes with readNodes
+        breakerReset - seconds before a probe request is let through an
+                    open breaker
+        sessionAuth - if True and using user/password, Basic Auth is only used
+                    to create a JSESSIONID/XSRF session on the first request.
+                    The session is re-created on 401, or 403 responses
+                    reporting an invalid session
+        sessionCache - if True, also keep the session in a per-manager
+                    cache file so other invocations can reuse it
+        versionTtl - seconds the manager version is cached on disk.  Within
+                    the TTL no version request is sent, after it the cached
+                    version is used while it's refreshed in the background.
+                    None disables the cache
+        codec - 'json' or 'orjson', default orjson if it's installed
+        inventory - if True, lookups by Nsx_object share an index of the
+                    collections they list, see inventory.Inventory
+        inventoryCache - if True, listed collections are also kept in an
+                    SQLite file shared with other invocations for the same
+                    manager, user, version, org and project
+        inventoryTtl - seconds a cached collection is used without being
+                    revalidated, 0 revalidates on first use in each process
+        singleFlight - if True, identical GET requests issued while one is
+                    in flight share its response, see the 'collapsed' counter
+
+        One NsxConnect can be shared between threads, they share one
+        requests.Session whose pool holds poolMaxsize connections per host
         '''
 
 
@@ -46,9 +667,40 @@ class NsxConnect(requests.Request):
         self.domain=domain
         self.org=org
         self.project=project
-        
-
-        self.session = requests.Session()
+        self.poolConnections=poolConnections
+        self.poolMaxsize=poolMaxsize
+        self.poolBlock=poolBlock
+        self.keepalive=keepalive
+        self.threadLocal = threading.local()
+        self.sharedSession = None
+        self.sharedSessionLock = threading.Lock()
+        self.limiter = TokenBucket(rate=rate, burst=burst) if rate else None
+        self.maxRetries=maxRetries
+        self.retryCodes=retryCodes
+        self.backoff=backoff
+        self.maxBackoff=maxBackoff
+        self.window = AdaptiveWindow(minimum=minWindow, maximum=maxWindow) if adaptive else None
+        self.statsLock = threading.Lock()
+        self.counters = collections.Counter()
+        self.nodePool = None
+        self.breakerThreshold = breakerThreshold
+        self.breakerReset = breakerReset
+        self.breakers = {}
+        self.sessionLock = threading.Lock()
+        self.sessionGeneration = 0
+        self.sessionCreated = None
+        self.sessionAuth = False
+        self.sessionCache = None
+        self.codec = getCodec(codec)
+        self.inventory = Inventory(self) if inventory else None
+        self.flights = SingleFlight() if singleFlight else None
+        # incremented after every write, see SingleFlight
+        self.writeGeneration = 0
+        self.versionTtl = versionTtl
+        self.versionCache = None
+        if versionTtl is not None:
+            self.versionCache = os.path.join(cacheDir('versions'), '%s_%s.json'
+                                             %(server, self.port))
         
         if self.access_token:
               self.requestAttr = {
@@ -68,16 +720,12 @@ class NsxConnect(requests.Request):
             with open(self.cookie) as f:
                 headers = CaseInsensitiveDict(json.loads(f.read()))
                 self.requestAttr.pop('auth')
-                self.requestAttr['headers']['Cookie'] = headers['set-cookie'].split()[0].strip(';')
-                self.requestAttr['headers']['X-xsrf-token'] = headers['x-xsrf-token']
+                self.requestAttr['headers'].update(self.sessionHeaders(headers))
 
 
         # if certificate given
         if self.cert:
             self.requestAttr.pop('auth')
-            self.session.cert = self.cert.split(',')
-            self.session.headers.update(self.requestAttr['headers'])
-            self.session.verify=verify
             
         # revert to using auth if header is still there.  VIDM auth if @ in username          
         if 'auth' in self.requestAttr:
@@ -86,23 +734,157 @@ class NsxConnect(requests.Request):
                 creds = "%s:%s" %(self.username, self.password)
                 creds = creds.encode()
                 self.requestAttr['headers']['Authorization'] = 'Remote %s' % base64.b64encode(creds)
+        if not self.keepalive:
+            self.requestAttr['headers']['Connection'] = 'close'
+        # automatic session only replaces plain Basic Auth
+        if (sessionAuth or sessionCache) and 'auth' in self.requestAttr:
+            self.sessionAuth = True
+            self.basicRequestAttr = self.requestAttr
+            if sessionCache:
+                self.sessionCache = os.path.join(cacheDir('sessions'), '%s_%s_%s.json'
+                                                 %(server, self.port, self.username))
+                self.loadSessionCache()
         if isNsx:
             self.version = self.getVersion()
+        if readNodes:
+            self.discoverNodes(mode=readNodes)
+        if inventoryCache and self.inventory:
+            self.useInventoryCache(ttl=inventoryTtl)
+
+    @property
+    def session(self):
+        '''
+        The requests.Session shared by all threads, its connection pool
+        keeps at most poolMaxsize connections per host.  Auth and session
+        headers are passed per request so the Session is never mutated
+        '''
+        if not self.sharedSession:
+            with self.sharedSessionLock:
+                if not self.sharedSession:
+                    self.sharedSession = self.newSession()
+        return self.sharedSession
+
+    def newSession(self):
+        '''
+        Create a requests.Session using the pool and auth settings
+        '''
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=self.poolConnections,
+                                                pool_maxsize=self.poolMaxsize,
+                                                pool_block=self.poolBlock)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        if self.cert:
+            session.cert = self.cert.split(',')
+            session.headers.update(self.requestAttr['headers'])
+            session.verify=self.verify
+        return session
 
     def getVersion(self):
         # for API compatibility purposes, only get major and minor
         if self.global_gm:
             return 0
+        if self.versionCache:
+            return self.getCachedVersion()
+        return self.fetchVersion()
+
+    def fetchVersion(self):
+        '''
+        Retrieve the version from the manager, update the cache if enabled
+        '''
         v = self.get(api='/api/v1/node/version', verbose=False, codes=[200])
         versionStr = v['product_version'].split('.')
         version=int("%s%s" % (versionStr[0],versionStr[1]))
+        if self.versionCache:
+            writeCacheFile(self.versionCache, {'version': version,
+                                               'product_version': v['product_version'],
+                                               'timestamp': time.time()})
+        return version
+
+    def getCachedVersion(self):
+        '''
+        Version from the cache file.  Fetched synchronously if not cached,
+        refreshed in the background if older than versionTtl
+        '''
+        try:
+            with open(self.versionCache) as f:
+                cached = json.loads(f.read())
+            version = int(cached['version'])
+        except (OSError, ValueError, KeyError):
+            return self.fetchVersion()
+        if time.time() - cached.get('timestamp', 0) > self.versionTtl:
+            # not a daemon so a short lived process still completes the refresh
+            threading.Thread(target=self.refreshVersion).start()
         return version
 
+    def refreshVersion(self):
+        try:
+            self.version = self.fetchVersion()
+        except Exception as e:
+            print("Background version refresh failed: %s" %e)
+
+    def hasCapability(self, name):
+        '''
+        True if the manager version supports the API capability name,
+        see CAPABILITIES.  Does not send any request
+        '''
+        if name not in CAPABILITIES:
+            raise ValueError("Unknown capability %s" %name)
+        if self.global_gm:
+            return name != 'projects' and name != 'vpc'
+        return self.version >= CAPABILITIES[name]
+
+    def getCapabilities(self):
+        return versionCapabilities(self.version)
+
+    def discoverNodes(self, mode='round-robin'):
+        '''
+        Find the manager cluster members, same API as Cluster.nodes(), and
+        spread future reads across them
+        '''
+        r = self.get(api='/api/v1/cluster/nodes', verbose=False, codes=[200])
+        servers = []
+        for n in r['results']:
+            if 'manager_role' not in n:
+                continue
+            addr = n['manager_role'].get('api_listen_addr', {})
+            host = addr.get('ip_address') or n.get('fqdn')
+            if not host:
+                continue
+            servers.append('https://%s:%s' % (host, addr.get('port', self.port)))
+        if not servers:
+            print("No manager nodes discovered, reads will use %s" %self.server)
+            return None
+        self.nodePool = NodePool(servers=servers, mode=mode, probe=self.probeNode)
+        return servers
+
+    def probeNode(self, server):
+        '''
+        Health check for one manager node, True if the node is serving API
+        '''
+        r = self.session.get(server+'/api/v1/reverse-proxy/node/health',
+                             timeout=self.timeout or 10, **self.requestAttr)
+        return r.status_code == 200
+
+    def useInventoryCache(self, ttl=0):
+        '''
+        Serve and save inventory collections through the SQLite cache
+        in cacheDir('inventory'), scoped by manager, user, version, org and
+        project since what a user can list depends on its role
+        '''
+        scope = '%s/%s/%s/%s/%s' % (self.server, self.username, getattr(self, 'version', 0),
+                                    self.org, self.project or '')
+        self.inventory.disk = DiskCache(filename=os.path.join(cacheDir('inventory'),
+                                                              'inventory.db'),
+                                        scope=scope, codec=self.codec)
+        self.inventory.ttl = ttl
+        return self.inventory.disk
+
     def getGlobalInfra(self):
         return self.global_infra
     def getGlobalGm(self):
         return self.global_gm
-    def setHeader(header, app):
+    def setHeader(self, header, app):
         if header in self.headers:
             self.headers.pop(header)
             self.headers[header] = app
@@ -167,14 +949,281 @@ class NsxConnect(requests.Request):
                                             i['id'],
                                             i['path'] if 'path' in i.keys() else "-"))
                     
-    def __checkReturnCode(self, result, codes):
+    def sessionHeaders(self, headers):
         '''
-        Checks HTTP requests result.status_code against a list of accepted codes
+        Returns the Cookie and X-XSRF-TOKEN request headers for
+        the headers of a /api/session/create response
+        '''
+        headers = CaseInsensitiveDict(headers)
+        return {'Cookie': headers['set-cookie'].split()[0].strip(';'),
+                'X-xsrf-token': headers['x-xsrf-token']}
+
+    def requestSession(self):
+        '''
+        Create a remote session with Basic Auth, returns the session
+        related response headers or None on failure
+        '''
+        requestAttr = dict(getattr(self, 'basicRequestAttr', self.requestAttr))
+        requestAttr['headers'] = dict(requestAttr['headers'])
+        requestAttr['headers']['Content-Type']= 'application/x-www-form-urlencoded'
+        requestAttr['headers']['Accept'] = '*/*'
+        requestAttr['headers'].pop('Cookie', None)
+        requestAttr['headers'].pop('X-xsrf-token', None)
+        data={'j_username': self.username, 'j_password': self.password}
+        r = self.session.post(self.server+'/api/session/create', data=data,
+                              timeout=self.timeout, **requestAttr)
+        self.count('session_creates')
+        if 'set-cookie' not in  (k.lower() for k in r.headers.keys()):
+            return None
+        return {k:v for k,v in r.headers.items()
+                if k.lower() in ['set-cookie', 'x-xsrf-token', 'date']}
+
+    def useSession(self, headers):
+        '''
+        Switch requests from Basic Auth to the session in headers
+        '''
+        requestAttr = {k:v for k,v in self.basicRequestAttr.items() if k != 'auth'}
+        requestAttr['headers'] = dict(requestAttr['headers'])
+        requestAttr['headers'].update(self.sessionHeaders(headers))
+        # swap the whole dictionary so other threads never see a partial update
+        self.requestAttr = requestAttr
+        self.sessionGeneration += 1
+        self.sessionCreated = time.monotonic()
+
+    def loadSessionCache(self):
+        if not os.path.exists(self.sessionCache):
+            return False
+        try:
+            with open(self.sessionCache) as f:
+                self.useSession(json.loads(f.read()))
+        except (ValueError, KeyError, OSError):
+            return False
+        # age unknown, may be refreshed right away
+        self.sessionCreated = None
+        return True
+
+    def ensureSession(self, staleGeneration=None):
+        '''
+        Create the automatic session if there is none yet, or re-create
+        it if it is still the session of staleGeneration
+        '''
+        with self.sessionLock:
+            if staleGeneration is None and 'auth' not in self.requestAttr:
+                return
+            if staleGeneration is not None and staleGeneration != self.sessionGeneration:
+                # another thread has already refreshed the session
+                return
+            headers = self.requestSession()
+            if not headers:
+                print("set-cookie not found in header, using Basic Auth")
+                self.requestAttr = self.basicRequestAttr
+                self.sessionAuth = False
+                return
+            self.useSession(headers)
+            if self.sessionCache:
+                writeCacheFile(self.sessionCache, headers)
+
+    def sessionExpired(self, result):
+        '''
+        True if result shows the automatic session is no longer valid: a
+        401, or a 403 whose error mentions the session, and the session
+        isn't one just created
+        '''
+        if result.status_code not in (401, 403):
+            return False
+        if self.sessionCreated and time.monotonic() - self.sessionCreated < SESSION_MIN_AGE:
+            return False
+        if result.status_code == 401:
+            return True
+        text = result.text.lower()
+        return any(w in text for w in SESSION_ERRORS)
+
+    def retryDelay(self, result, attempt):
+        '''
+        Seconds to wait before retrying a request that returned a retryable
+        status.  Uses the Retry-After header if present, otherwise
+        exponential backoff with full jitter
+        '''
+        retryAfter = result.headers.get('Retry-After')
+        if retryAfter:
+            try:
+                delay = float(retryAfter)
+            except ValueError:
+                try:
+                    delay = (email.utils.parsedate_to_datetime(retryAfter) -
+                             datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(delay, 0), self.maxBackoff) + random.uniform(0, self.backoff)
+        return random.uniform(0, min(self.maxBackoff, self.backoff * (2 ** attempt)))
+
+    def send(self, method, url, read=False, **kwargs):
+        '''
+        Send one request through the rate limiter, retrying with backoff
+        while the manager responds with one of self.retryCodes.
+        If read is True and cluster node load balancing is enabled, the
+        request goes to one of the cluster nodes instead of self.server
+        '''
+        if method == 'GET':
+            return self.__sendRetried(method, url, read=read, **kwargs)
+        try:
+            return self.__sendRetried(method, url, read=read, **kwargs)
+        finally:
+            # even a failed write may have been applied
+            self.wrote()
+
+    def wrote(self):
+        '''
+        Start a new write generation, later GETs don't share responses
+        of requests sent before
+        '''
+        with self.statsLock:
+            self.writeGeneration += 1
+
+    def __sendRetried(self, method, url, read=False, **kwargs):
+        attempt = 0
+        refreshed = False
+        while True:
+            if self.sessionAuth:
+                self.ensureSession()
+                generation = self.sessionGeneration
+            if self.limiter:
+                self.limiter.acquire()
+            if read and self.nodePool:
+                r = self.__sendToNode(method, url, **kwargs)
+            else:
+                r = self.__sendOnce(method, url, **kwargs)
+            self.count('requests')
+            if self.sessionAuth and not refreshed and self.sessionExpired(r):
+                # session expired or was invalidated, create a new one once
+                r.close()
+                refreshed = True
+                self.ensureSession(staleGeneration=generation)
+                self.count('session_refreshes')
+                continue
+            if r.status_code not in self.retryCodes or attempt >= self.maxRetries:
+                return r
+            self.count('retries')
+            r.close()
+            time.sleep(self.retryDelay(r, attempt))
+            attempt += 1
+
+    def __sendToNode(self, method, url, **kwargs):
+        '''
+        Send a read to a healthy cluster node, moving on to the next
+        node on connection errors or timeouts
+        '''
+        api = url[len(self.server):]
+        for i in range(len(self.nodePool.nodes)):
+            node = self.nodePool.pick()
+            if not node:
+                break
+            start = time.monotonic()
+            try:
+                r = self.__sendOnce(method, node+api, **kwargs)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                self.nodePool.report(node, failed=True)
+                self.count('node_failovers')
+                continue
+            if r.status_code in (502, 504):
+                self.nodePool.report(node, failed=True)
+                self.count('node_failovers')
+                continue
+            self.nodePool.report(node, latency=time.monotonic() - start)
+            return r
+        # no healthy node left, fall back to the configured server
+        return self.__sendOnce(method, url, **kwargs)
+
+    def getBreaker(self, url):
+        '''
+        Returns the circuit breaker for the server in url
+        '''
+        server = url[:url.find('/', url.find('//') + 2)]
+        with self.statsLock:
+            if server not in self.breakers:
+                self.breakers[server] = CircuitBreaker(server=server,
+                                                       threshold=self.breakerThreshold,
+                                                       resetTimeout=self.breakerReset)
+            return self.breakers[server]
+
+    def __sendOnce(self, method, url, **kwargs):
+        if not self.breakerThreshold:
+            return self.__sendWindowed(method, url, **kwargs)
+        breaker = self.getBreaker(url)
+        breaker.allow()
+        try:
+            r = self.__sendWindowed(method, url, **kwargs)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            breaker.failure()
+            raise
+        except Exception:
+            breaker.abort()
+            raise
+        breaker.success()
+        return r
+
+    def __sendWindowed(self, method, url, **kwargs):
+        if not self.window:
+            return self.session.request(method, url, timeout=self.timeout,
+                                        **self.requestAttr, **kwargs)
+        sequence = self.window.acquire()
+        start = time.monotonic()
+        try:
+            r = self.session.request(method, url, timeout=self.timeout,
+                                     **self.requestAttr, **kwargs)
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+            self.window.release(sequence=sequence, congested=True)
+            raise
+        except Exception:
+            self.window.release(sequence=sequence)
+            raise
+        if r.status_code in self.retryCodes:
+            self.window.release(sequence=sequence, congested=True)
+        else:
+            self.window.release(sequence=sequence, latency=time.monotonic() - start)
+        return r
+
+    def count(self, name, value=1):
+        '''
+        Increment the named counter reported by getStats()
+        '''
+        with self.statsLock:
+            self.counters[name] += value
+
+    def getStats(self):
+        '''
+        Returns a dictionary of request counters and, when adaptive
+        concurrency is enabled, the current window and latency statistics
+        '''
+        with self.statsLock:
+            stats = dict(self.counters)
+        if self.window:
+            stats['window'] = self.window.getStats()
+        if self.nodePool:
+            stats['nodes'] = self.nodePool.getStats()
+        if self.inventory:
+            stats['inventory'] = self.inventory.getStats()
+        with self.statsLock:
+            breakers = list(self.breakers.values())
+        if breakers:
+            stats['breakers'] = {b.server: b.getStats() for b in breakers}
+        return stats
+
+    def checkStatus(self, status, text, codes):
+        '''
+        Checks an HTTP status code against a list of accepted codes
         '''
         if codes:
-            if result.status_code not in codes:
+            if status not in codes:
                 raise ValueError("Return code '%d' not in list of expected codes: %s\n %s"
-                      %(result.status_code,codes, result.text))
+                      %(status,codes, text))
+
+    def __checkReturnCode(self, result, codes):
+        '''
+        Checks HTTP requests result.status_code against a list of accepted codes
+        '''
+        self.checkStatus(result.status_code, result.text, codes)
 
             
     def get(self, api, verbose=True, trial=False, codes=None, display=False):
@@ -192,20 +1241,82 @@ class NsxConnect(requests.Request):
         if verbose:
             print("API: GET %s" %api)
         if not trial:
-            r = self.session.get(url, timeout=self.timeout,
-                                 **self.requestAttr)
+            if self.flights:
+                r, shared = self.flights.do(url, lambda: self.send('GET', url, read=True),
+                                            generation=self.writeGeneration)
+                if shared:
+                    self.count('collapsed')
+            else:
+                r = self.send('GET', url, read=True)
             self.__checkReturnCode(r, codes)
             if verbose:
                 print("result code: %d" % r.status_code)
-                #print(json.dumps(json.loads(r.text), indent=4))
         else:
             if verbose:
                 print("API not called - in safe mode")
             return None
+        # decode the body once, straight from bytes
+        data = self.codec.loads(r.content)
         if display:
-            self.jsonPrint(json.loads(r.text))
+            self.jsonPrint(data)
+
+        return data
+
+    def __written(self, method, api, data, result):
+        '''
+        Keep the inventory index consistent with a write
+        '''
+        if self.inventory and result.status_code < 300:
+            self.inventory.written(method=method, api=api, data=data)
+
+    def hapi(self, maxPayload=1000000, verbose=True):
+        '''
+        Context manager batching the PATCH requests sent by this thread:
+            with mp.hapi() as batch:
+                segments.config(...)
+                group.config(...)
+        Policy object PATCHes are queued and sent as Child<type> entries of
+        PATCH /policy/api/v1/infra requests of at most maxPayload bytes
+        when the block exits or batch.flush() is called.  Queued objects
+        are visible to inventory lookups.  Other writes, and PATCHes H-API
+        can't express, send the queue first.  Nothing is sent if the
+        block raises
+        '''
+        return HapiBatch(self, maxPayload=maxPayload, verbose=verbose)
 
-        return json.loads(r.text)
+    def __flushBatch(self):
+        # writes that can't be batched must not overtake queued ones
+        batch = getattr(self.threadLocal, 'batch', None)
+        if batch:
+            batch.flush()
+
+    def getStream(self, api, envelope=None, codes=None, chunkSize=65536, decoder=None):
+        '''
+        Generator version of get() for list APIs.  Items of the "results"
+        array are decoded and yielded as they arrive from the socket, so
+        memory use does not depend on the size of the response
+        api - REST API, this will be appended to self.server
+        envelope - optional dictionary, updated with the other top level
+                   fields (cursor, result_count...) once all items are read
+        codes - List of HTTP request status codes for success
+        decoder - incremental decoder, default ResultsDecoder(), see
+                  hapi.TreeDecoder for H-API trees
+        '''
+        api=self.normalizeGmLmApi(api)
+        url = self.server+api
+        r = self.send('GET', url, read=True, stream=True)
+        try:
+            self.__checkReturnCode(r, codes)
+            decoder = decoder or ResultsDecoder()
+            for chunk in r.iter_content(chunk_size=chunkSize):
+                for item in decoder.feed(chunk):
+                    yield item
+            for item in decoder.feed(b'', final=True):
+                yield item
+            if envelope is not None:
+                envelope.update(decoder.envelope())
+        finally:
+            r.close()
 
     def patch(self, api, data=None, verbose=True,trial=False, codes=None):
         '''
@@ -220,23 +1331,28 @@ class NsxConnect(requests.Request):
         '''
         api=self.normalizeGmLmApi(api=api)
         url=self.server+api
+        batch = getattr(self.threadLocal, 'batch', None)
+        if batch and not trial and batch.add(api=api, data=data):
+            if verbose:
+                print("API: PATCH %s batched with data:" %url)
+                print(self.codec.pretty(data))
+            return None
         if verbose:
             print("API: PATCH %s with data:" %url)
-            print(json.dumps(data, indent=4))
+            print(self.codec.pretty(data))
         if not trial:
-            r = self.session.patch(url,data=json.dumps(data),
-                                   timeout=self.timeout,
-                                   **self.requestAttr)
+            r = self.send('PATCH', url, data=self.codec.dumps(data))
+            self.__checkReturnCode(r, codes)
+            self.__written('PATCH', api, data, r)
             if verbose:
                 print('result code: %d' %r.status_code)
-                if r.text:
+                if r.content:
                     print(r.text)
-                    return json.loads(r.text)
+                    return self.codec.loads(r.content)
         else:
             if verbose:
                 print("API not called - in safe mode")
             return None
-        self.__checkReturnCode(r, codes)
         return  r
 
     def put(self, api, data=None,verbose=True,trial=False, codes=None):
@@ -255,16 +1371,16 @@ class NsxConnect(requests.Request):
         url=self.server+api
         if verbose:
             print("API: PUT %s with data:" %url)
-            print(json.dumps(data, indent=4))
+            print(self.codec.pretty(data))
 
         if not trial:
-            r = self.session.put(url, data=json.dumps(data),
-                                 timeout=self.timeout,
-                                 **self.requestAttr)
+            self.__flushBatch()
+            r = self.send('PUT', url, data=self.codec.dumps(data))
             self.__checkReturnCode(r, codes)
+            self.__written('PUT', api, data, r)
             if verbose:
                 print('result code: %d' %r.status_code)
-                return json.loads(r.text)
+                return self.codec.loads(r.content)
         else:
             if verbose:
                 print("API not called - in safe mode")
@@ -283,10 +1399,10 @@ class NsxConnect(requests.Request):
         if verbose:
             print("API: DELETE %s" %url)
         if not trial:
-            r = self.session.delete(url,timeout=self.timeout,
-                                    data=json.dumps(data), 
-                                    **self.requestAttr)
+            self.__flushBatch()
+            r = self.send('DELETE', url, data=self.codec.dumps(data))
             self.__checkReturnCode(r,codes)
+            self.__written('DELETE', api, data, r)
             if verbose:
                 print('result code: %d' %r.status_code)
                 return r.text
@@ -311,18 +1427,19 @@ class NsxConnect(requests.Request):
         url = self.server+api
         if verbose:
             print("API: POST %s with data" %url)
-            print(json.dumps(data, indent=4)) 
+            print(self.codec.pretty(data))
         if not trial:
-            r = self.session.post(url, data=json.dumps(data),
-                                  timeout=self.timeout,
-                                  **self.requestAttr)
+            self.__flushBatch()
+            r = self.send('POST', url, data=self.codec.dumps(data))
             self.__checkReturnCode(r, codes)
+            self.__written('POST', api, data, r)
             if verbose:
                 print('result code: %d' %r.status_code)
-            if r.text:
+            if r.content:
+                result = self.codec.loads(r.content)
                 if display:
-                    self.jsonPrint(json.loads(r.text))
-                return json.loads(r.text)
+                    self.jsonPrint(result)
+                return result
             else:
                 return None
         else:
@@ -330,6 +1447,57 @@ class NsxConnect(requests.Request):
                 print("API not called - in safe mode")
             return None
 
+    def mapRequests(self, func, argList, maxWorkers=None):
+        '''
+        Run func(**kwargs) for every kwargs dictionary in argList with at most
+        maxWorkers requests in flight.  Returns the results in the same order
+        as argList.  A failed call does not abort the batch, its exception is
+        returned in place of the result.  maxWorkers defaults to 8, or to
+        the maximum window when adaptive concurrency is enabled
+        '''
+        if not maxWorkers:
+            maxWorkers = self.window.maximum if self.window else 8
+        results = [None] * len(argList)
+        def run(index):
+            try:
+                results[index] = func(**argList[index])
+            except Exception as e:
+                results[index] = e
+        if not argList:
+            return results
+        with concurrent.futures.ThreadPoolExecutor(max_workers=maxWorkers) as ex:
+            list(ex.map(run, range(len(argList))))
+        return results
+
+    def mapGet(self, apis, maxWorkers=None, verbose=False, codes=None):
+        '''
+        GET every API in apis concurrently, see mapRequests()
+        '''
+        return self.mapRequests(self.get,
+                                [{'api': a, 'verbose': verbose, 'codes': codes}
+                                 for a in apis],
+                                maxWorkers=maxWorkers)
+
+    def mapPatch(self, items, maxWorkers=None, verbose=False, trial=False, codes=None):
+        '''
+        PATCH every (api, data) tuple in items concurrently, see mapRequests()
+        '''
+        return self.mapRequests(self.patch,
+                                [{'api': a, 'data': d, 'verbose': verbose,
+                                  'trial': trial, 'codes': codes}
+                                 for a,d in items],
+                                maxWorkers=maxWorkers)
+
+    def mapDelete(self, apis, maxWorkers=None, verbose=False, trial=False, codes=None):
+        '''
+        DELETE every API in apis concurrently, see mapRequests()
+        '''
+        return self.mapRequests(self.delete,
+                                [{'api': a, 'verbose': verbose,
+                                  'trial': trial, 'codes': codes}
+                                 for a in apis],
+                                maxWorkers=maxWorkers)
+
     def createSessionCookie(self, filename):
         '''
         Retrieve a remote session cookie that can be used for API requests
@@ -340,23 +1508,246 @@ class NsxConnect(requests.Request):
         if '@ddd' in self.username:
             api=self.server + '/api/v1/eula/acceptance'
             r = self.session.get(api, **self.requestAttr)
+            headers = None
+            if 'set-cookie' in  (k.lower() for k in r.headers.keys()):
+                headers = {k:v for k,v in r.headers.items()
+                           if k.lower() in ['set-cookie', 'x-xsrf-token', 'date']}
         else:
-            self.headers['Content-Type']= 'application/x-www-form-urlencoded'
-            self.headers['Accept'] = '*/*'
-            data='j_username=%s&j_password=%s' %(self.username,
-                                                 self.password)
-            api=self.server+'/api/session/create'
-            r = self.session.post(api, data=data, **self.requestAttr)
+            headers = self.requestSession()
         
-        if 'set-cookie' not in  (k.lower() for k in r.headers.keys()):
+        if not headers:
             print("set-cookie not found in header, failure to create session")
             return
             
         fp = open(filename, 'w')
 
-        fp.write(json.dumps({k:v for k,v in r.headers.items()
-                             if k.lower() in ['set-cookie',
-                                              'x-xsrf-token', 'date']}))
+        fp.write(json.dumps(headers))
+
+
+
+
 
 
+class AsyncNsxConnect(NsxConnect):
+    '''
+    asyncio version of NsxConnect built on aiohttp.  Takes the same arguments
+    and provides the same get/patch/put/delete/post calls as coroutines,
+    including normalizeGmLmApi rewriting, cookie/cert/bearer auth, codes
+    checking, rate limiting, retries and circuit breakers.  adaptive,
+    readNodes, sessionAuth and sessionCache are not supported.  The version probe and the aiohttp session need a running
+    event loop, so use it as an async context manager:
 
+        async with AsyncNsxConnect(server=mgr, password=pw) as mp:
+            s = nsxobjects.Segments(mp=mp)
+            r = await s.listAsync()
+    '''
+    def __init__(self, server, limit=100, **kwargs):
+        '''
+        limit - max number of simultaneous connections to the server
+        All other arguments are the same as NsxConnect
+        '''
+        if not aiohttp:
+            raise ImportError("AsyncNsxConnect requires the aiohttp module")
+        unsupported = [k for k in ('adaptive', 'readNodes', 'sessionAuth', 'sessionCache')
+                       if kwargs.get(k)]
+        if unsupported:
+            raise ValueError("AsyncNsxConnect does not support %s" % ', '.join(unsupported))
+        self.isNsx = kwargs.pop('isNsx', True)
+        super(AsyncNsxConnect, self).__init__(server=server, isNsx=False, **kwargs)
+        self.limit = limit
+        self.version = None
+        self.asession = None
+        self.aflights = {}
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, excType, exc, tb):
+        await self.close()
+
+    async def open(self):
+        '''
+        Create the aiohttp session and retrieve the NSX version
+        '''
+        if self.asession:
+            return
+        if self.cert:
+            sslCtx = ssl.create_default_context()
+            if not self.verify:
+                sslCtx.check_hostname = False
+                sslCtx.verify_mode = ssl.CERT_NONE
+            # .p12 bundles are not supported by the ssl module, only crt,key
+            sslCtx.load_cert_chain(*self.cert.split(','))
+        elif not self.verify:
+            sslCtx = False
+        else:
+            sslCtx = None
+
+        auth = None
+        if 'auth' in self.requestAttr:
+            auth = aiohttp.BasicAuth(*self.requestAttr['auth'])
+        timeout = aiohttp.ClientTimeout(total=float(self.timeout)) if self.timeout else None
+        self.asession = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.limit, ssl=sslCtx),
+            headers=dict(self.requestAttr['headers']),
+            auth=auth, timeout=timeout)
+        if self.isNsx:
+            self.version = await self.getVersion()
+
+    async def close(self):
+        if self.asession:
+            await self.asession.close()
+            self.asession = None
+
+    async def getVersion(self):
+        if self.global_gm:
+            return 0
+        v = await self.get(api='/api/v1/node/version', verbose=False, codes=[200])
+        versionStr = v['product_version'].split('.')
+        version=int("%s%s" % (versionStr[0],versionStr[1]))
+        return version
+
+    async def amILM(self):
+        d = await self.get(api='/policy/api/v1/infra/federation-config', verbose=False, codes=[200,404])
+        if 'error_code' in d:
+            return False
+        return True
+
+    async def __request(self, method, api, data=None, sendData=True, codes=None):
+        '''
+        Submit one request through the rate limiter, retrying with backoff
+        while the manager responds with one of self.retryCodes, return
+        tuple of (status, text)
+        '''
+        if not self.asession:
+            await self.open()
+        url = self.server+api
+        kwargs = {}
+        if sendData:
+            kwargs['data'] = self.codec.dumps(data)
+        attempt = 0
+        while True:
+            if self.limiter:
+                await self.limiter.acquireAsync()
+            r, body = await self.__sendOnce(method, url, **kwargs)
+            self.count('requests')
+            if r.status not in self.retryCodes or attempt >= self.maxRetries:
+                break
+            self.count('retries')
+            await asyncio.sleep(self.retryDelay(r, attempt))
+            attempt += 1
+        if codes and r.status not in codes:
+            self.checkStatus(r.status, body.decode(errors='replace'), codes)
+        return r.status, body
+
+    async def __sendOnce(self, method, url, **kwargs):
+        # returns the closed response, for its status and headers, and the body
+        breaker = self.getBreaker(url) if self.breakerThreshold else None
+        if breaker:
+            breaker.allow()
+        try:
+            async with self.asession.request(method, url, **kwargs) as r:
+                body = await r.read()
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            if breaker:
+                breaker.failure()
+            raise
+        except BaseException:
+            # including cancellation, which would leave a probe in flight
+            if breaker:
+                breaker.abort()
+            raise
+        if breaker:
+            breaker.success()
+        return r, body
+
+    async def __sharedGet(self, api):
+        '''
+        GET api, sharing the request with identical GETs in flight
+        '''
+        generation = self.writeGeneration
+        task, started = self.aflights.get(api, (None, None))
+        if task and started >= generation:
+            self.count('collapsed')
+        else:
+            # an older request keeps running for the callers that joined it
+            task = asyncio.ensure_future(self.__request('GET', api, sendData=False))
+            self.aflights[api] = (task, generation)
+            task.add_done_callback(lambda t: self.aflights.pop(api, None)
+                                   if self.aflights.get(api, (None,))[0] is t else None)
+        # a cancelled caller must not cancel the request for the others
+        return await asyncio.shield(task)
+
+    async def get(self, api, verbose=True, trial=False, codes=None, display=False):
+        '''
+        REST API get request, see NsxConnect.get
+        '''
+        api=self.normalizeGmLmApi(api)
+        if verbose:
+            print("API: GET %s" %api)
+        if trial:
+            if verbose:
+                print("API not called - in safe mode")
+            return None
+        if self.flights:
+            status, body = await self.__sharedGet(api)
+            self.checkStatus(status, body.decode(errors='replace'), codes)
+        else:
+            status, body = await self.__request('GET', api, sendData=False, codes=codes)
+        if verbose:
+            print("result code: %d" % status)
+        data = self.codec.loads(body)
+        if display:
+            self.jsonPrint(data)
+        return data
+
+    async def __write(self, method, api, data, verbose, trial, codes):
+        api=self.normalizeGmLmApi(api)
+        if verbose:
+            print("API: %s %s%s with data:" %(method, self.server, api))
+            print(self.codec.pretty(data))
+        if trial:
+            if verbose:
+                print("API not called - in safe mode")
+            return None
+        try:
+            status, body = await self.__request(method, api, data=data, codes=codes)
+        finally:
+            self.wrote()
+        if verbose:
+            print('result code: %d' %status)
+        return body
+
+    async def patch(self, api, data=None, verbose=True,trial=False, codes=None):
+        '''
+        REST API patch request, returns the decoded response body if any
+        '''
+        body = await self.__write('PATCH', api, data, verbose, trial, codes)
+        return self.codec.loads(body) if body else None
+
+    async def put(self, api, data=None,verbose=True,trial=False, codes=None):
+        '''
+        REST API put request, returns the decoded response body if any
+        '''
+        body = await self.__write('PUT', api, data, verbose, trial, codes)
+        return self.codec.loads(body) if body else None
+
+    async def delete(self, api, data=None, verbose=True,trial=False,codes=None):
+        '''
+        REST API delete request, returns the response text
+        '''
+        body = await self.__write('DELETE', api, data, verbose, trial, codes)
+        return body.decode() if body is not None else None
+
+    async def post(self, api, data=None,verbose=True,trial=False, codes=None, display=False):
+        '''
+        REST API post request, returns the decoded response body if any
+        '''
+        body = await self.__write('POST', api, data, verbose, trial, codes)
+        if not body:
+            return None
+        r = self.codec.loads(body)
+        if display:
+            self.jsonPrint(r)
+        return r
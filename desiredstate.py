@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+import re
+import json
+import nsxobjects
+from hapi import HAPI_COLLECTIONS, exportTree
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# parent of the objects of these types when the spec doesn't give one,
+# %s is the domain
+DEFAULT_PARENTS = {
+    'Group': '/infra/domains/%s',
+    'SecurityPolicy': '/infra/domains/%s',
+    'GatewayPolicy': '/infra/domains/%s',
+}
+
+# keys of a spec entry that aren't fields of the object
+SPEC_KEYS = ('type', 'id', 'parent', 'path')
+
+# "@Tier1:DemoT1" is replaced by the path of the Tier1 named DemoT1
+REFERENCE = re.compile(r'^@([A-Za-z0-9]+):(.+)$')
+
+def loadSpec(filename):
+    '''
+    Returns the list of objects in a desired state file, YAML if PyYAML
+    is installed, JSON otherwise.  The file is a list of objects, or a
+    dictionary with an "objects" list
+    '''
+    with open(filename) as f:
+        if yaml:
+            spec = yaml.safe_load(f)
+        elif filename.endswith(('.yaml', '.yml')):
+            raise ValueError("PyYAML is required to read %s, use JSON instead" % filename)
+        else:
+            spec = json.load(f)
+    if isinstance(spec, dict):
+        spec = spec.get('objects', [])
+    if not isinstance(spec, list):
+        raise ValueError("%s: expected a list of objects" % filename)
+    return spec
+
+def localPath(path):
+    '''
+    Policy path without the org/project prefix, global-infra as infra
+    '''
+    path = re.sub(r'^/orgs/[^/]+/projects/[^/]+', '', path)
+    return re.sub(r'^/global-infra(?=/|$)', '/infra', path)
+
+def differs(current, desired):
+    '''
+    True if desired isn't already in current.  Fields that desired leaves
+    out, like the ones the manager adds, are ignored
+    '''
+    if isinstance(desired, dict):
+        if not isinstance(current, dict):
+            return True
+        return any(differs(current.get(k), v) for k,v in desired.items())
+    if isinstance(desired, list):
+        if not isinstance(current, list) or len(current) != len(desired):
+            return True
+        return any(differs(c, d) for c,d in zip(current, desired))
+    return current != desired
+
+def merge(current, desired):
+    '''
+    desired with the fields it leaves out of nested dictionaries taken from
+    current, PATCH replaces a field as a whole
+    '''
+    if isinstance(desired, dict) and isinstance(current, dict):
+        value = dict(current)
+        for k,v in desired.items():
+            value[k] = merge(current.get(k), v)
+        return value
+    return desired
+
+def pathReferences(value, found=None):
+    '''
+    Set of the policy paths (strings starting with /) in value
+    '''
+    if found is None:
+        found = set()
+    if isinstance(value, dict):
+        for v in value.values():
+            pathReferences(v, found)
+    elif isinstance(value, list):
+        for v in value:
+            pathReferences(v, found)
+    elif isinstance(value, str) and value.startswith('/'):
+        found.add(localPath(value))
+    return found
+
+def dependencyLevels(deps):
+    '''
+    deps maps each node to the set of nodes it depends on.  Returns the
+    list of levels, each a sorted list of nodes that only depend on nodes
+    of earlier levels.  Raises ValueError if there is a cycle
+    '''
+    remaining = dict((n, set(d) & set(deps)) for n,d in deps.items())
+    levels = []
+    while remaining:
+        level = sorted(n for n,d in remaining.items() if not d)
+        if not level:
+            raise ValueError("Dependency cycle between: %s" % ', '.join(sorted(remaining)))
+        for n in level:
+            del remaining[n]
+        for d in remaining.values():
+            d.difference_update(level)
+        levels.append(level)
+    return levels
+
+class DesiredState(object):
+    '''
+    Plans and applies a list of policy objects described by a spec, see
+    loadSpec().  Each entry has a type (resource_type), an id or a
+    display_name, and the fields to set.  An entry with only a display_name
+    updates the object of that name under the same parent, whatever its id,
+    or creates one with the name as id.  Nested objects give their parent
+    path or their full path.  String values "@<type>:<display_name>" are
+    replaced by the path of that object
+    '''
+    def __init__(self, mp, spec):
+        self.mp = mp
+        self.spec = spec
+        self.current = None
+        self.paths = None
+
+    def desired(self):
+        '''
+        Returns the list of (path, type, data, byName) from the spec,
+        byName is True if the id in path was taken from the display_name
+        '''
+        objs = []
+        for entry in self.spec:
+            rtype = entry.get('type')
+            if not rtype:
+                raise ValueError("Object without type: %s" % entry)
+            data = dict((k,v) for k,v in entry.items() if k not in SPEC_KEYS)
+            data['resource_type'] = rtype
+            path = entry.get('path')
+            byName = not path and not entry.get('id')
+            if not path:
+                oid = entry.get('id') or data.get('display_name')
+                if not oid:
+                    raise ValueError("%s needs an id, display_name or path" % rtype)
+                if rtype not in HAPI_COLLECTIONS:
+                    raise ValueError("%s %s needs a path" %(rtype, oid))
+                parent = entry.get('parent') or DEFAULT_PARENTS.get(rtype, '/infra')
+                if '%s' in parent:
+                    parent = parent % self.mp.domain
+                path = '%s/%s/%s' %(parent.rstrip('/'), HAPI_COLLECTIONS[rtype], oid)
+            objs.append((localPath(path), rtype, data, byName))
+        return objs
+
+    def match(self, path, rtype, data):
+        '''
+        Path of the current object of rtype named data['display_name'] in
+        the same collection as path, path itself if there is none
+        '''
+        if path in self.current:
+            return path
+        collection = path.rsplit('/', 1)[0]
+        found = [p for p,o in self.current.items()
+                 if o.get('resource_type') == rtype and p.rsplit('/', 1)[0] == collection
+                 and o.get('display_name') == data['display_name']]
+        if len(found) > 1:
+            raise ValueError("%s %s matches several objects: %s"
+                             %(rtype, data['display_name'], ', '.join(sorted(found))))
+        return found[0] if found else path
+
+    def snapshot(self, types):
+        '''
+        Current objects of types by path, from one H-API GET of infra
+        '''
+        self.current = {}
+        for o in exportTree(mp=self.mp, typeFilter=';'.join(sorted(types)), types=types):
+            self.current[localPath(o['path'])] = o
+        return self.current
+
+    def references(self, value, found):
+        # collect the (type, name) references in value
+        if isinstance(value, dict):
+            for v in value.values():
+                self.references(v, found)
+        elif isinstance(value, list):
+            for v in value:
+                self.references(v, found)
+        elif isinstance(value, str):
+            m = REFERENCE.match(value)
+            if m:
+                found.setdefault(m.group(1), set()).add(m.group(2))
+        return found
+
+    def resolve(self, value):
+        if isinstance(value, dict):
+            return dict((k, self.resolve(v)) for k,v in value.items())
+        if isinstance(value, list):
+            return [self.resolve(v) for v in value]
+        if isinstance(value, str):
+            m = REFERENCE.match(value)
+            if m:
+                return self.paths[(m.group(1), m.group(2))]
+        return value
+
+    def resolveNames(self, objs, refs):
+        '''
+        Map the (type, name) references to paths: objects of the spec
+        first, then the snapshot, then one search per type for the rest
+        '''
+        self.paths = {}
+        for path,rtype,data in objs:
+            if 'display_name' in data:
+                self.paths[(rtype, data['display_name'])] = path
+        for path,o in self.current.items():
+            self.paths.setdefault((o.get('resource_type'), o.get('display_name')), path)
+        finder = nsxobjects.Nsx_object(mp=self.mp)
+        for rtype,names in sorted(refs.items()):
+            pending = sorted(n for n in names if (rtype, n) not in self.paths)
+            if pending:
+                for n,p in finder.resolvePaths(resourceType=rtype, names=pending).items():
+                    self.paths[(rtype, n)] = p
+
+    def plan(self):
+        '''
+        Returns the changes needed, a list of dictionaries with action
+        ('create', 'update' or 'unchanged'), path, type, data (what to
+        PATCH, only the changed fields for updates) and fields (changed
+        field to (current, desired))
+        '''
+        objs = self.desired()
+        if not objs:
+            return []
+        refs = {}
+        for path,rtype,data,byName in objs:
+            self.references(data, refs)
+        types = set(o[1] for o in objs) | set(t for t in refs if t in HAPI_COLLECTIONS)
+        self.snapshot(types)
+        objs = [(self.match(path, rtype, data) if byName else path, rtype, data)
+                for path,rtype,data,byName in objs]
+        for path,rtype,data in objs:
+            if path not in self.current:
+                # new objects are named after their id, existing ones keep
+                # their name unless the spec sets it
+                data.setdefault('display_name', path.rsplit('/', 1)[-1])
+        self.resolveNames(objs, refs)
+
+        changes = []
+        for path,rtype,data in objs:
+            data = self.resolve(data)
+            current = self.current.get(path)
+            if not current:
+                changes.append({'action': 'create', 'path': path, 'type': rtype,
+                                'data': data,
+                                'fields': dict((k, (None, v)) for k,v in data.items())})
+                continue
+            fields = dict((k, (current.get(k), v)) for k,v in data.items()
+                          if differs(current.get(k), v))
+            patch = dict((k, merge(current.get(k), v)) for k,(c,v) in fields.items())
+            if patch:
+                patch['resource_type'] = rtype
+            changes.append({'action': 'update' if patch else 'unchanged', 'path': path,
+                            'type': rtype, 'data': patch, 'fields': fields})
+        return changes
+
+    def apply(self, changes=None, verbose=False, maxPayload=1000000):
+        '''
+        PATCH the planned changes in H-API batches, returns the changes
+        '''
+        if changes is None:
+            changes = self.plan()
+        with self.mp.hapi(maxPayload=maxPayload, verbose=verbose):
+            for c in changes:
+                if c['action'] == 'unchanged':
+                    continue
+                self.mp.patch(api='/policy/api/v1%s' % c['path'], data=c['data'],
+                              verbose=verbose, codes=[200])
+        return changes
+
+    def dependencies(self, changes):
+        '''
+        Maps the path of each change to the paths of the other changes it
+        refers to (tier0_path, connectivity_path, group paths...) or is
+        nested below
+        '''
+        paths = set(c['path'] for c in changes)
+        deps = {}
+        for c in changes:
+            refs = pathReferences(c['data'])
+            parent = c['path']
+            while '/' in parent.strip('/'):
+                parent = parent.rsplit('/', 1)[0]
+                refs.add(parent)
+            deps[c['path']] = (refs & paths) - set([c['path']])
+        return deps
+
+    def applyParallel(self, changes=None, maxWorkers=8, verbose=False):
+        '''
+        PATCH the planned changes one dependency level at a time, see
+        dependencies(), with at most maxWorkers requests in flight.  Changes
+        depending on a failed one are skipped.  Sets the status of each
+        change to 'applied', 'failed' (with its error) or 'skipped' and
+        returns the changes
+        '''
+        if changes is None:
+            changes = self.plan()
+        todo = dict((c['path'], c) for c in changes if c['action'] != 'unchanged')
+        deps = self.dependencies(list(todo.values()))
+        for level in dependencyLevels(deps):
+            run = []
+            for path in level:
+                c = todo[path]
+                if any(todo[d]['status'] != 'applied' for d in deps[path]):
+                    c['status'] = 'skipped'
+                else:
+                    run.append(c)
+            results = self.mp.mapPatch(items=[('/policy/api/v1%s' % c['path'], c['data'])
+                                              for c in run],
+                                       maxWorkers=maxWorkers, verbose=verbose, codes=[200])
+            for c,r in zip(run, results):
+                if isinstance(r, Exception):
+                    c['status'] = 'failed'
+                    c['error'] = str(r)
+                else:
+                    c['status'] = 'applied'
+        return changes
+
+def printPlan(changes, verbose=False):
+    '''
+    Print the changes returned by DesiredState.plan()
+    '''
+    marks = {'create': '+', 'update': '~', 'unchanged': '='}
+    for c in changes:
+        if c['action'] == 'unchanged' and not verbose:
+            continue
+        print("%s %s %s" %(marks[c['action']], c['type'], c['path']))
+        for k,(old,new) in sorted(c['fields'].items()):
+            if k == 'resource_type' or c['action'] == 'create' and not verbose:
+                continue
+            print("    %s: %s -> %s" %(k, json.dumps(old), json.dumps(new)))
+    counts = dict((a, len([c for c in changes if c['action'] == a])) for a in marks)
+    print("Plan: %(create)d to create, %(update)d to update, %(unchanged)d unchanged" % counts)
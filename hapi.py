@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+import re
+import json
+import codecs
+import threading
+
+# H-API type of the objects in each policy collection, used to build
+# Child<type> entries and ChildResourceReference parents.  Writes to
+# other collections are not batched
+HAPI_TYPES = {
+    'domains': 'Domain',
+    'groups': 'Group',
+    'security-policies': 'SecurityPolicy',
+    'gateway-policies': 'GatewayPolicy',
+    'rules': 'Rule',
+    'services': 'Service',
+    'segments': 'Segment',
+    'ports': 'SegmentPort',
+    'tier-0s': 'Tier0',
+    'tier-1s': 'Tier1',
+    'locale-services': 'LocaleServices',
+    'nat': 'PolicyNat',
+    'nat-rules': 'PolicyNatRule',
+    'static-routes': 'StaticRoutes',
+    'prefix-lists': 'PrefixList',
+    'route-maps': 'Tier0RouteMap',
+    'community-lists': 'CommunityList',
+    'ip-pools': 'IpAddressPool',
+    'ip-subnets': 'IpAddressPoolSubnet',
+    'dhcp-relay-configs': 'DhcpRelayConfig',
+    'dhcp-server-configs': 'DhcpServerConfig',
+    'lb-services': 'LBService',
+    'lb-pools': 'LBPool',
+    'lb-virtual-servers': 'LBVirtualServer',
+    'lb-app-profiles': 'LBAppProfile',
+    'lb-monitor-profiles': 'LBMonitorProfile',
+    'lb-persistence-profiles': 'LBPersistenceProfile',
+    'lb-client-ssl-profiles': 'LBClientSslProfile',
+    'lb-server-ssl-profiles': 'LBServerSslProfile',
+    'context-profiles': 'PolicyContextProfile',
+}
+
+def splitPolicyApi(api):
+    '''
+    Returns (infraApi, [(collection, id), ...]) for a normalized policy
+    object API below infra, None if it can't be written through H-API
+    '''
+    m = re.match(r'^(/(?:policy|global-manager)/api/v1(?:/orgs/[^/]+/projects/[^/]+)?'
+                 r'/(?:global-)?infra)((?:/[^/?]+/[^/?]+)+)$', api)
+    if not m:
+        return None
+    parts = m.group(2).strip('/').split('/')
+    return m.group(1), list(zip(parts[0::2], parts[1::2]))
+
+class HapiBatch(object):
+    '''
+    Collects the PATCH requests sent through NsxConnect.patch() by this
+    thread and sends them as Child<type> entries of one or a few
+    PATCH <infra> requests, see NsxConnect.hapi().  Writes that H-API
+    can't express are sent as usual after the queued ones
+    '''
+    def __init__(self, mp, maxPayload=1000000, verbose=True):
+        self.mp = mp
+        self.maxPayload = maxPayload
+        self.verbose = verbose
+        self.queue = {}
+        self.outer = None
+        # pending objects are only visible to the thread writing them
+        self.owner = threading.get_ident()
+
+    def __enter__(self):
+        self.outer = getattr(self.mp.threadLocal, 'batch', None)
+        if self.outer:
+            # nested batches join the outermost one
+            return self.outer
+        self.mp.threadLocal.batch = self
+        return self
+
+    def __exit__(self, excType, exc, tb):
+        if self.outer:
+            return False
+        self.mp.threadLocal.batch = None
+        if excType:
+            # the block failed, nothing queued is sent
+            self.discard()
+            return False
+        self.flush()
+        return False
+
+    def add(self, api, data):
+        '''
+        Queue a PATCH of data to the normalized api.  Returns False, after
+        sending what's queued, if H-API can't express the write
+        '''
+        split = splitPolicyApi(api)
+        if (not split or not isinstance(data, dict) or
+            not all(HAPI_TYPES.get(c) for c,i in split[1])):
+            self.flush()
+            return False
+        infra, pairs = split
+        entry = self.queue.get(api)
+        if entry:
+            entry['data'].update(data)
+        else:
+            entry = {'infra': infra, 'pairs': pairs, 'type': HAPI_TYPES[pairs[-1][0]],
+                     'data': dict(data)}
+            self.queue[api] = entry
+        if self.mp.inventory:
+            path = re.sub(r'^/(policy|global-manager)/api/v1', '', api)
+            obj = self.child(entry)[entry['type']]
+            self.mp.inventory.pendingWrite(path=path, obj=dict(obj, path=path),
+                                           owner=self.owner)
+        return True
+
+    def discard(self):
+        if self.mp.inventory:
+            self.mp.inventory.clearPending(owner=self.owner)
+        self.queue = {}
+
+    def child(self, entry):
+        '''
+        Child<type> entry of a queued write.  The wrapper type is the one
+        of the collection, the object keeps its own resource_type, e.g.
+        LBHttpProfile in a ChildLBAppProfile
+        '''
+        obj = dict(entry['data'])
+        obj['id'] = entry['pairs'][-1][1]
+        obj.setdefault('resource_type', entry['type'])
+        return {'resource_type': 'Child%s' % entry['type'], entry['type']: obj}
+
+    def tree(self, entries):
+        '''
+        Infra object with the entries as children.  Parents that aren't
+        written themselves are ChildResourceReference entries
+        '''
+        root = {'resource_type': 'Infra', 'children': []}
+        nodes = {(): root}
+        for e in entries:
+            chain = ()
+            parent = root
+            for c,i in e['pairs'][:-1]:
+                chain += ((c, i),)
+                if chain not in nodes:
+                    ref = {'resource_type': 'ChildResourceReference', 'id': i,
+                           'target_type': HAPI_TYPES[c], 'children': []}
+                    parent['children'].append(ref)
+                    nodes[chain] = ref
+                parent = nodes[chain]
+            chain += (e['pairs'][-1],)
+            child = self.child(e)
+            obj = child[e['type']]
+            if chain in nodes:
+                # written after one of its children, replace the reference
+                ref = nodes[chain]
+                obj['children'] = ref.get('children', []) + obj.get('children', [])
+                ref.clear()
+                ref.update(child)
+            else:
+                parent['children'].append(child)
+            obj.setdefault('children', [])
+            nodes[chain] = obj
+        self.prune(root)
+        return root
+
+    def prune(self, obj):
+        '''
+        Remove empty children lists
+        '''
+        for c in obj.get('children', []):
+            # Child<type> wraps the object, a ChildResourceReference is its own node
+            self.prune(c.get(c['resource_type'][len('Child'):], c))
+        if 'children' in obj and not obj['children']:
+            del obj['children']
+
+    def chunks(self):
+        '''
+        Lists of queued entries per infra API, each under maxPayload bytes
+        once encoded, in the order they were queued
+        '''
+        chunk = []
+        size = 0
+        for e in self.queue.values():
+            n = len(self.mp.codec.dumps(self.child(e)))
+            if chunk and (size + n > self.maxPayload or e['infra'] != chunk[0]['infra']):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(e)
+            size += n
+        if chunk:
+            yield chunk
+
+    def flush(self):
+        '''
+        Send everything queued, returns the list of responses
+        '''
+        results = []
+        try:
+            for chunk in self.chunks():
+                infra = chunk[0]['infra']
+                body = self.tree(chunk)
+                url = self.mp.server + infra
+                if self.verbose:
+                    print("API: PATCH %s with %d objects" %(url, len(chunk)))
+                r = self.mp.send('PATCH', url, data=self.mp.codec.dumps(body))
+                self.mp.checkStatus(r.status_code, r.text, [200])
+                self.mp.count('hapiRequests')
+                self.mp.count('hapiObjects', len(chunk))
+                if self.mp.inventory:
+                    for e in chunk:
+                        self.mp.inventory.written(method='PATCH', api=self.apiOf(e),
+                                                  data=e['data'])
+                results.append(r)
+        finally:
+            self.discard()
+        return results
+
+    def apiOf(self, entry):
+        return entry['infra'] + ''.join('/%s/%s' % p for p in entry['pairs'])
+
+# collection of each resource_type, to build the path of objects returned
+# without one, including the concrete types of the H-API ones
+HAPI_COLLECTIONS = dict((t, c) for c,t in HAPI_TYPES.items())
+for c,types in [('ip-subnets', ['IpAddressPoolStaticSubnet', 'IpAddressPoolBlockSubnet']),
+                ('lb-app-profiles', ['LBHttpProfile', 'LBFastTcpProfile',
+                                     'LBFastUdpProfile']),
+                ('lb-monitor-profiles', ['LBHttpMonitorProfile', 'LBHttpsMonitorProfile',
+                                         'LBIcmpMonitorProfile', 'LBTcpMonitorProfile',
+                                         'LBUdpMonitorProfile', 'LBPassiveMonitorProfile']),
+                ('lb-persistence-profiles', ['LBCookiePersistenceProfile',
+                                             'LBSourceIpPersistenceProfile',
+                                             'LBGenericPersistenceProfile'])]:
+    for t in types:
+        HAPI_COLLECTIONS[t] = c
+
+class TreeDecoder(object):
+    '''
+    Incremental decoder for H-API GET responses.  Feed it the body in
+    chunks of bytes and it returns each policy object of the tree, without
+    its children and with its path, as soon as the object is complete.
+    Only the objects being decoded and their ancestors are kept, so memory
+    doesn't grow with the tree and every byte is scanned about once.
+    Nested objects are returned before their parents.  After the last
+    chunk, envelope() returns the fields of the root object
+    '''
+    def __init__(self, rootPath='/infra'):
+        self.decoder = json.JSONDecoder()
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.rootPath = rootPath
+        self.buf = ''
+        self.stack = []
+        self.root = None
+
+    def feed(self, chunk, final=False):
+        '''
+        Add a chunk of the body, returns the list of completed objects
+        '''
+        self.buf += self.utf8.decode(chunk, final)
+        items = []
+        pos = self.__parse(items, final)
+        self.buf = self.buf[pos:]
+        if final and (self.stack or self.buf.strip()):
+            raise ValueError("Truncated or malformed H-API response")
+        return items
+
+    def envelope(self):
+        return self.root or {}
+
+    def __skip(self, pos, chars=' \t\r\n'):
+        buf = self.buf
+        while pos < len(buf) and buf[pos] in chars:
+            pos += 1
+        return pos
+
+    def __parse(self, items, final):
+        # frames are 'children' arrays, 'wrapper' Child<type> or
+        # ChildResourceReference entries, and 'entity' objects.  Only the
+        # values of children, and the object in a wrapper, are descended
+        # into, everything else is decoded whole
+        buf = self.buf
+        n = len(buf)
+        pos = 0
+        while True:
+            pos = self.__skip(pos, ' \t\r\n,')
+            if pos >= n:
+                return pos
+            c = buf[pos]
+            if not self.stack:
+                if self.root is not None:
+                    # trailing data after the root object
+                    return pos if final else n
+                if c != '{':
+                    raise ValueError("H-API response is not an object")
+                self.stack.append({'kind': 'entity', 'obj': {}})
+                pos += 1
+                continue
+            top = self.stack[-1]
+            if top['kind'] == 'children':
+                if c == ']':
+                    self.stack.pop()
+                    pos += 1
+                elif c == '{':
+                    self.stack.append({'kind': 'wrapper', 'obj': {}})
+                    pos += 1
+                else:
+                    raise ValueError("Unexpected %r in H-API children" % c)
+                continue
+            if c == '}':
+                self.stack.pop()
+                self.__close(top, items)
+                pos += 1
+                continue
+            # one "key": value member, started over if it's incomplete
+            try:
+                key, p = self.decoder.raw_decode(buf, pos)
+            except ValueError:
+                return pos
+            p = self.__skip(p)
+            if p >= n:
+                return pos
+            if buf[p] != ':':
+                raise ValueError("Expected ':' after %r in H-API response" % key)
+            p = self.__skip(p + 1)
+            if p >= n:
+                return pos
+            if key == 'children' and buf[p] == '[':
+                self.stack.append({'kind': 'children'})
+                pos = p + 1
+                continue
+            if top['kind'] == 'wrapper' and buf[p] == '{':
+                self.stack.append({'kind': 'entity', 'obj': {}})
+                pos = p + 1
+                continue
+            try:
+                value, end = self.decoder.raw_decode(buf, p)
+            except ValueError:
+                return pos
+            if not final and (end >= n or buf[end] not in ' \t\r\n,}]'):
+                # a number like 1. or 1e may continue in the next chunk
+                return pos
+            top['obj'][key] = value
+            pos = end
+
+    def __path(self, index):
+        '''
+        Path of the object of stack frame index, for children without one
+        '''
+        for i in range(index, -1, -1):
+            frame = self.stack[i]
+            obj = frame.get('obj', {})
+            if frame['kind'] == 'entity':
+                rtype = obj.get('resource_type')
+            elif obj.get('resource_type') == 'ChildResourceReference':
+                rtype = obj.get('target_type')
+            else:
+                continue
+            if obj.get('path'):
+                return obj['path']
+            if i == 0:
+                return self.rootPath
+            return '%s/%s/%s' %(self.__path(i - 1), HAPI_COLLECTIONS.get(rtype, rtype),
+                                obj.get('id'))
+        return self.rootPath
+
+    def __close(self, frame, items):
+        if frame['kind'] != 'entity':
+            return
+        obj = frame['obj']
+        if not self.stack:
+            self.root = obj
+            return
+        if not obj.get('path'):
+            obj['path'] = '%s/%s/%s' %(self.__path(len(self.stack) - 1),
+                                       HAPI_COLLECTIONS.get(obj.get('resource_type'),
+                                                            obj.get('resource_type')),
+                                       obj.get('id'))
+        items.append(obj)
+
+def exportTree(mp, filter=None, typeFilter=None, basePath=None, types=None):
+    '''
+    Generator over the policy objects returned by one H-API GET of infra,
+    decoded with TreeDecoder as the response arrives, nested objects
+    before their parents
+    filter - H-API filter, e.g. 'Type-Domain|Group', default 'Type-' (all types)
+    typeFilter - H-API type_filter, e.g. 'Group;Segment'
+    basePath - only return the subtree below this path
+    types - only yield objects with these resource_types
+    '''
+    # without a filter only the infra object itself is returned
+    params = ['filter=%s' % (filter or 'Type-')]
+    if typeFilter:
+        params.append('type_filter=%s' % typeFilter)
+    if basePath:
+        params.append('base_path=%s' % basePath)
+    api = '/policy/api/v1/infra?' + '&'.join(params)
+    root = re.sub(r'^/(policy|global-manager)/api/v1', '',
+                  mp.normalizeGmLmApi(api).split('?')[0])
+    for item in mp.getStream(api=api, codes=[200], decoder=TreeDecoder(rootPath=root)):
+        if not types or item.get('resource_type') in types:
+            yield item
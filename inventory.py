@@ -0,0 +1,706 @@
+#!/usr/bin/env python
+import copy
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+class Record(object):
+    '''
+    Compact index entry for an object listed with only lookup fields
+    (see Nsx_object.lookupFields).  Reads like a dictionary, a few times
+    smaller than one
+    '''
+    __slots__ = ('id', 'display_name', 'path', 'resource_type', 'tags',
+                 '_last_modified_time', '_revision')
+    fields = frozenset(__slots__)
+
+    def __init__(self, obj):
+        for f,v in obj.items():
+            setattr(self, f, v)
+
+    def __contains__(self, field):
+        return hasattr(self, field)
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def asDict(self):
+        return dict((f, copy.deepcopy(getattr(self, f)))
+                    for f in self.__slots__ if hasattr(self, f))
+
+def compact(obj):
+    '''
+    obj as a Record if it only has Record fields
+    '''
+    if isinstance(obj, dict) and Record.fields.issuperset(obj):
+        return Record(obj)
+    return obj
+
+def export(obj):
+    '''
+    A dictionary copy of an index entry for callers
+    '''
+    if isinstance(obj, Record):
+        return obj.asDict()
+    return copy.deepcopy(obj)
+
+class Collection(object):
+    '''
+    The objects returned by one list API, indexed by any field on demand
+    '''
+    def __init__(self, api, rawApi=None):
+        self.api = api
+        self.rawApi = rawApi or api
+        self.objects = []
+        self.indexes = {}
+        self.complete = False
+        self.reconciled = time.time()
+
+    def key(self, obj):
+        return obj.get('path') or obj.get('id')
+
+    def add(self, obj):
+        obj = compact(obj)
+        self.objects.append(obj)
+        for field,index in self.indexes.items():
+            if field in obj:
+                index.setdefault(obj[field], []).append(obj)
+
+    def remove(self, key):
+        '''
+        Remove the object with path/id key and everything below it
+        '''
+        keep = []
+        for o in self.objects:
+            k = self.key(o)
+            if k == key or (k and k.startswith(key + '/')):
+                continue
+            keep.append(o)
+        if len(keep) != len(self.objects):
+            self.objects = keep
+            self.indexes = {}
+
+    def merge(self, objects):
+        '''
+        Replace the objects with the same path/id, append new ones
+        '''
+        pos = dict((self.key(o), i) for i,o in enumerate(self.objects))
+        for o in objects:
+            o = compact(o)
+            k = self.key(o)
+            if k in pos:
+                self.objects[pos[k]] = o
+            else:
+                pos[k] = len(self.objects)
+                self.objects.append(o)
+        self.indexes = {}
+
+    def retain(self, keys):
+        '''
+        Remove the objects whose path/id is not in keys, returns the
+        number removed
+        '''
+        keep = [o for o in self.objects if self.key(o) in keys]
+        removed = len(self.objects) - len(keep)
+        if removed:
+            self.objects = keep
+            self.indexes = {}
+        return removed
+
+    def newest(self):
+        return max([o.get('_last_modified_time', 0) for o in self.objects] or [None])
+
+    def index(self, field):
+        '''
+        dictionary of field value to the list of objects with that value,
+        in list order
+        '''
+        if field not in self.indexes:
+            index = {}
+            for o in self.objects:
+                if field in o:
+                    index.setdefault(o[field], []).append(o)
+            self.indexes[field] = index
+        return self.indexes[field]
+
+    def find(self, field, value, ignorecase=False):
+        if not ignorecase:
+            found = self.index(field).get(value)
+            return found[0] if found else None
+        for o in self.objects:
+            if field in o and o[field].lower() == value.lower():
+                return o
+        return None
+
+class DiskCache(object):
+    '''
+    SQLite store of list results shared by nsxt.py invocations.  Rows are
+    keyed by scope (manager, user, version, org and project) and normalized list
+    API, each object is kept with its _last_modified_time and _revision.
+    The count and newest _last_modified_time of a collection are kept to
+    revalidate it with a single page_size=1 request
+    '''
+    def __init__(self, filename, scope, codec):
+        self.filename = filename
+        self.scope = scope
+        self.codec = codec
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS collections ('
+                            'scope TEXT, api TEXT, rawApi TEXT, validated REAL, '
+                            'count INTEGER, newest INTEGER, reconciled REAL, '
+                            'PRIMARY KEY (scope, api))')
+            try:
+                # files written before reconciliation was tracked
+                self.db.execute('ALTER TABLE collections ADD COLUMN reconciled REAL')
+            except sqlite3.OperationalError:
+                pass
+            self.db.execute('CREATE TABLE IF NOT EXISTS objects ('
+                            'scope TEXT, api TEXT, seq INTEGER, key TEXT, '
+                            'lastModified INTEGER, revision INTEGER, data BLOB, '
+                            'PRIMARY KEY (scope, api, seq))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS objectKeys '
+                            'ON objects (scope, key)')
+
+    def keys(self):
+        with self.lock:
+            return [r[0] for r in self.db.execute(
+                'SELECT api FROM collections WHERE scope=?', (self.scope,))]
+
+    def meta(self, api):
+        '''
+        Returns dictionary with rawApi, validated, count and newest of the
+        cached collection, or None
+        '''
+        with self.lock:
+            r = self.db.execute('SELECT rawApi, validated, count, newest, reconciled '
+                                'FROM collections WHERE scope=? AND api=?',
+                                (self.scope, api)).fetchone()
+        if not r:
+            return None
+        return {'rawApi': r[0], 'validated': r[1], 'count': r[2], 'newest': r[3],
+                'reconciled': r[4]}
+
+    def load(self, api):
+        '''
+        Objects of the cached collection api in list order
+        '''
+        with self.lock:
+            rows = self.db.execute('SELECT data FROM objects WHERE scope=? AND api=? '
+                                   'ORDER BY seq', (self.scope, api)).fetchall()
+        return [self.codec.loads(r[0]) for r in rows]
+
+    def store(self, api, rawApi, objects, reconciled=None):
+        '''
+        Replace the cached collection api with objects.  reconciled is the
+        time the object ids were last checked, default now
+        '''
+        newest = max([o.get('_last_modified_time', 0) for o in objects] or [None])
+        rows = []
+        for seq,o in enumerate(objects):
+            rows.append((self.scope, api, seq, o.get('path') or o.get('id'),
+                         o.get('_last_modified_time'), o.get('_revision'),
+                         self.codec.dumps(o.asDict() if isinstance(o, Record) else o)))
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM objects WHERE scope=? AND api=?', (self.scope, api))
+            self.db.executemany('INSERT INTO objects VALUES (?,?,?,?,?,?,?)', rows)
+            self.db.execute('INSERT OR REPLACE INTO collections VALUES (?,?,?,?,?,?,?)',
+                            (self.scope, api, rawApi, time.time(), len(objects), newest,
+                             reconciled or time.time()))
+
+    def touch(self, api, reconciled=None):
+        with self.lock, self.db:
+            self.db.execute('UPDATE collections SET validated=? WHERE scope=? AND api=?',
+                            (time.time(), self.scope, api))
+            if reconciled:
+                self.db.execute('UPDATE collections SET reconciled=? WHERE scope=? AND api=?',
+                                (reconciled, self.scope, api))
+
+    def remove(self, key):
+        '''
+        Remove the object with path key and everything below it from all
+        collections, keeping the collection counts in step
+        '''
+        with self.lock, self.db:
+            # a prefix comparison, LIKE would treat _ and % in ids as wildcards
+            below = (len(key) + 1, key + '/')
+            rows = self.db.execute('SELECT api, COUNT(*) FROM objects WHERE scope=? '
+                                   'AND (key=? OR substr(key, 1, ?)=?) GROUP BY api',
+                                   (self.scope, key) + below).fetchall()
+            for api,n in rows:
+                self.db.execute('UPDATE collections SET count=count-? WHERE scope=? AND api=?',
+                                (n, self.scope, api))
+            self.db.execute('DELETE FROM objects WHERE scope=? '
+                            'AND (key=? OR substr(key, 1, ?)=?)',
+                            (self.scope, key) + below)
+
+    def expire(self, api=None, allScopes=False):
+        '''
+        Drop the cached collection api, all collections of this scope, or
+        with allScopes everything in the file.  Returns the number of
+        collections dropped
+        '''
+        where = ''
+        params = ()
+        if not allScopes:
+            where = ' WHERE scope=?'
+            params = (self.scope,)
+            if api:
+                where += ' AND api=?'
+                params += (api,)
+        with self.lock, self.db:
+            n = self.db.execute('DELETE FROM collections' + where, params).rowcount
+            self.db.execute('DELETE FROM objects' + where, params)
+        return n
+
+    def getCollections(self, allScopes=False):
+        '''
+        List of dictionaries describing the cached collections
+        '''
+        sql = 'SELECT scope, api, validated, count, newest FROM collections'
+        params = ()
+        if not allScopes:
+            sql += ' WHERE scope=?'
+            params = (self.scope,)
+        with self.lock:
+            rows = self.db.execute(sql + ' ORDER BY scope, api', params).fetchall()
+        return [{'scope': r[0], 'api': r[1], 'validated': r[2],
+                 'count': r[3], 'newest': r[4]} for r in rows]
+
+class Inventory(object):
+    '''
+    In process index of NSX collections shared by all Nsx_object instances
+    using the same NsxConnect, available as mp.inventory.  Each collection
+    is listed once, later lookups by display_name, id, path or any other
+    field are dictionary lookups.  Writes sent through NsxConnect update
+    or invalidate the affected collections.  With a DiskCache collections
+    are also served from and saved to disk, a cached collection older than
+    ttl seconds is revalidated before use
+    '''
+    def __init__(self, mp, disk=None, ttl=0):
+        self.mp = mp
+        self.disk = disk
+        self.ttl = ttl
+        self.collections = {}
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.invalidations = 0
+        self.diskHits = 0
+        self.revalidations = 0
+        self.stale = 0
+        self.pending = {}
+        self.searches = 0
+        self.syncs = 0
+        self.deltaObjects = 0
+        self.reconciliations = 0
+
+    def collection(self, api, loader):
+        '''
+        Returns the complete collection for api, calling loader() to list
+        the objects if it's not loaded yet
+        '''
+        key = self.mp.normalizeGmLmApi(api)
+        with self.lock:
+            c = self.collections.get(key)
+            if c and c.complete:
+                return c
+        c = None
+        if self.disk:
+            c = self.fromDisk(api=api, key=key)
+        if not c:
+            c = Collection(api=key, rawApi=api)
+            for o in loader():
+                c.add(o)
+            c.complete = True
+            if self.disk:
+                self.disk.store(api=key, rawApi=api, objects=c.objects)
+            with self.lock:
+                self.loads += 1
+        with self.lock:
+            self.collections[key] = c
+        return c
+
+    def fromDisk(self, api, key):
+        '''
+        The collection from the disk cache, revalidated if older than ttl.
+        None if not cached or changed on the manager
+        '''
+        meta = self.disk.meta(key)
+        if not meta:
+            return None
+        if time.time() - meta['validated'] > self.ttl:
+            with self.lock:
+                self.revalidations += 1
+            if not self.revalidate(api=api, meta=meta):
+                with self.lock:
+                    self.stale += 1
+                return None
+            self.disk.touch(key)
+        c = Collection(api=key, rawApi=api)
+        for o in self.disk.load(key):
+            c.add(o)
+        c.complete = True
+        c.reconciled = meta['reconciled'] or 0
+        with self.lock:
+            self.diskHits += 1
+        return c
+
+    def probe(self, api):
+        '''
+        Returns (result_count, newest _last_modified_time) of api from a
+        single page_size=1 request, None if the request fails
+        '''
+        url = '%s%spage_size=1&sort_by=_last_modified_time&sort_ascending=false' % (
+            api, '&' if '?' in api else '?')
+        try:
+            r = self.mp.get(api=url, verbose=False, codes=[200])
+        except Exception as e:
+            print("Inventory probe of %s failed: %s" %(api, e))
+            return None
+        results = r.get('results') or []
+        return (r.get('result_count'),
+                results[0].get('_last_modified_time') if results else None)
+
+    def revalidate(self, api, meta):
+        '''
+        True if the manager still has meta['count'] objects in api and the
+        most recently modified one has the cached newest _last_modified_time
+        '''
+        return self.probe(api) == (meta['count'], meta['newest'])
+
+    def pages(self, api, includedFields=None):
+        '''
+        Generator of all objects of api following cursors
+        '''
+        if includedFields and 'included_fields=' in api:
+            base, _, query = api.partition('?')
+            query = '&'.join(q for q in query.split('&') if not q.startswith('included_fields='))
+            api = '%s?%s' % (base, query) if query else base
+        cursor = None
+        while True:
+            params = ['page_size=1000']
+            if includedFields:
+                params.append('included_fields=%s' % ','.join(includedFields))
+            if cursor:
+                params.append('cursor=%s' % cursor)
+            r = self.mp.get(api='%s%s%s' % (api, '&' if '?' in api else '?', '&'.join(params)),
+                            verbose=False, codes=[200])
+            results = r.get('results') or []
+            for o in results:
+                yield self.__clean(api, o)
+            if (not results or 'cursor' not in r or
+                str(r['cursor']) == str(r.get('result_count'))):
+                return
+            cursor = r['cursor']
+
+    def __clean(self, api, obj):
+        # same fields as Nsx_object.iterList(removeSearch=True)
+        if '/search/query' in api:
+            obj.pop('status', None)
+        return obj
+
+    def deltaQueries(self, c, since):
+        '''
+        search/query APIs returning the objects of collection c modified
+        after since, one per resource_type.  None if the collection can't
+        be expressed as a search
+        '''
+        base, _, query = c.rawApi.partition('?')
+        params = urllib.parse.parse_qsl(query)
+        if base.endswith('/search/query'):
+            # the collection query already selects its resource_type
+            terms = [q for k,q in params if k == 'query']
+            if len(terms) != 1:
+                return None
+            others = [(k,v) for k,v in params if k != 'query']
+        elif (re.match(r'^/(policy|global-manager)/api/v1/', base) and
+              all(k == 'included_fields' for k,v in params)):
+            types = sorted(set(o['resource_type'] for o in c.objects if 'resource_type' in o))
+            if not types:
+                return None
+            terms = ['resource_type:%s' % t for t in types]
+            others = params
+            base = re.sub(r'/api/v1/.*$', '/api/v1/search/query', base)
+        else:
+            return None
+        apis = []
+        for t in terms:
+            q = [('query', '(%s) AND _last_modified_time:>%d' % (t, since))] + others
+            apis.append('%s?%s' % (base, urllib.parse.urlencode(q, quote_via=urllib.parse.quote,
+                                                                safe=':*')))
+        return apis
+
+    def __member(self, c, obj):
+        # search results for a plain list API must have the collection as parent
+        if '/search/query' in c.api or 'path' not in obj:
+            return True
+        m = re.match(r'^/(?:policy|global-manager)/api/v1(/.*)$',
+                     c.api.split('?')[0].rstrip('/'))
+        return bool(m) and obj['path'].rsplit('/', 1)[0] == m.group(1)
+
+    def sync(self, api=None, reconcileAfter=3600, reconcile=False):
+        '''
+        Bring loaded and cached collections up to date, all of them or just
+        api.  Objects modified after the newest cached _last_modified_time
+        are fetched with search/query and merged.  Deleted objects are found
+        by listing only ids and paths, when the count doesn't add up, every
+        reconcileAfter seconds, or always with reconcile=True.  Returns a
+        list of (api, changed, removed), removed is None after a full list
+        '''
+        with self.lock:
+            keys = set(k for k,c in self.collections.items() if c.complete)
+        if self.disk:
+            keys.update(self.disk.keys())
+        if api:
+            keys = set([self.mp.normalizeGmLmApi(api)]) & keys
+        synced = []
+        for key in sorted(keys):
+            r = self.syncCollection(key=key, reconcileAfter=reconcileAfter,
+                                    reconcile=reconcile)
+            if r:
+                synced.append(r)
+        return synced
+
+    def relist(self, c):
+        fresh = Collection(api=c.api, rawApi=c.rawApi)
+        for o in self.pages(c.rawApi):
+            fresh.add(o)
+        fresh.complete = True
+        return fresh
+
+    def syncCollection(self, key, reconcileAfter=3600, reconcile=False):
+        with self.lock:
+            c = self.collections.get(key)
+        if c and not c.complete:
+            c = None
+        if not c and self.disk:
+            meta = self.disk.meta(key)
+            if meta:
+                c = Collection(api=key, rawApi=meta['rawApi'])
+                for o in self.disk.load(key):
+                    c.add(o)
+                c.complete = True
+                c.reconciled = meta['reconciled'] or 0
+        if not c:
+            return None
+        current = self.probe(c.rawApi)
+        if current is None:
+            return None
+        with self.lock:
+            self.syncs += 1
+        count, newest = current
+        since = c.newest()
+        changed = 0
+        removed = 0
+        if newest != since:
+            apis = self.deltaQueries(c, since) if since is not None else None
+            if apis:
+                objects = []
+                for url in apis:
+                    objects.extend(o for o in self.pages(url) if self.__member(c, o))
+                with self.lock:
+                    c.merge(objects)
+                changed = len(objects)
+            else:
+                # no usable delta, list everything again
+                c = self.relist(c)
+                changed = len(c.objects)
+                removed = None
+        if removed is not None and (reconcile or len(c.objects) != count or
+                                    time.time() - c.reconciled > reconcileAfter):
+            # ids are only unique per parent, so list paths as well
+            keys = set(c.key(o) for o in self.pages(c.rawApi, includedFields=['id', 'path']))
+            with self.lock:
+                removed = c.retain(keys)
+                self.reconciliations += 1
+            c.reconciled = time.time()
+            if len(keys) != len(c.objects):
+                # objects the delta didn't return, list again
+                c = self.relist(c)
+                removed = None
+        with self.lock:
+            self.deltaObjects += changed
+            self.collections[key] = c
+        if self.disk:
+            if changed or removed != 0:
+                self.disk.store(api=key, rawApi=c.rawApi, objects=c.objects,
+                                reconciled=c.reconciled)
+            else:
+                self.disk.touch(key, reconciled=c.reconciled)
+        return (key, changed, removed)
+
+    def lookup(self, api, field, value, ignorecase=False):
+        '''
+        Returns (known, obj) from the loaded collection of api without
+        sending requests.  known is False if the object may exist but
+        isn't loaded, obj is a copy
+        '''
+        key = self.mp.normalizeGmLmApi(api)
+        with self.lock:
+            obj = self.__pendingFind(key, field, value, ignorecase)
+            if obj:
+                self.hits += 1
+                return (True, export(obj))
+            c = self.collections.get(key)
+            if not c:
+                return (False, None)
+            obj = c.find(field=field, value=value, ignorecase=ignorecase)
+            if obj or c.complete:
+                self.hits += 1
+                return (True, export(obj) if obj else None)
+            return (False, None)
+
+    def pendingWrite(self, path, obj, owner):
+        '''
+        Make obj, queued to be written to path by the H-API batch of the
+        thread owner, visible to that thread's lookups before it's sent
+        '''
+        with self.lock:
+            self.pending.setdefault(owner, {})[path] = obj
+
+    def clearPending(self, owner):
+        with self.lock:
+            self.pending.pop(owner, None)
+
+    def __pendingFind(self, key, field, value, ignorecase):
+        base = key.split('?')[0].rstrip('/')
+        types = None
+        if base.endswith('/search/query'):
+            types = re.findall(r'resource_type:([A-Za-z0-9]+)', key)
+        else:
+            m = re.match(r'^/(?:policy|global-manager)/api/v1(/.*)$', base)
+            if not m:
+                return None
+        for path,o in self.pending.get(threading.get_ident(), {}).items():
+            if field not in o:
+                continue
+            if types is not None:
+                if o.get('resource_type') not in types:
+                    continue
+            elif path.rsplit('/', 1)[0] != m.group(1):
+                continue
+            if o[field] == value or (ignorecase and o[field].lower() == value.lower()):
+                return o
+        return None
+
+    def remember(self, api, objects):
+        '''
+        Keep objects found by search in the partial collection of api
+        '''
+        key = self.mp.normalizeGmLmApi(api)
+        with self.lock:
+            self.searches += 1
+            c = self.collections.get(key)
+            if objects and not c:
+                c = Collection(api=key, rawApi=api)
+                self.collections[key] = c
+            if objects and not c.complete:
+                c.merge(objects)
+
+    def find(self, api, field, value, loader, ignorecase=False, search=None):
+        '''
+        Returns a copy of the first object of api whose field matches
+        value, or None.  Without a disk cache, if the collection isn't
+        loaded and search is given, search() asks the manager for just the
+        object and the result is kept in a partial collection
+        '''
+        known, obj = self.lookup(api=api, field=field, value=value, ignorecase=ignorecase)
+        if known:
+            return obj
+        with self.lock:
+            self.misses += 1
+        if search and not self.disk:
+            obj = search()
+            self.remember(api=api, objects=[obj] if obj else [])
+            return export(obj) if obj else None
+        c = self.collection(api=api, loader=loader)
+        with self.lock:
+            obj = c.find(field=field, value=value, ignorecase=ignorecase)
+            return export(obj) if obj else None
+
+    def invalidate(self, api=None):
+        '''
+        Drop the collection for api, or all collections
+        '''
+        with self.lock:
+            if api:
+                key = self.mp.normalizeGmLmApi(api)
+                self.collections.pop(key, None)
+                if self.disk:
+                    self.disk.expire(api=key)
+            else:
+                self.collections = {}
+                if self.disk:
+                    self.disk.expire()
+            self.invalidations += 1
+
+    def written(self, method, api, data=None):
+        '''
+        Called by NsxConnect after a successful write to the normalized api.
+        Deletes are removed from the loaded collections, other writes drop
+        the collections they may affect
+        '''
+        base = api.split('?')[0].rstrip('/')
+        path = None
+        m = re.match(r'^/(?:policy|global-manager)/api/v1(/.*)$', base)
+        if m:
+            path = m.group(1)
+        rtype = data.get('resource_type') if isinstance(data, dict) else None
+
+        with self.lock:
+            if method == 'DELETE' and path:
+                for c in self.collections.values():
+                    c.remove(path)
+                if self.disk:
+                    self.disk.remove(path)
+                return
+            keys = set(self.collections)
+            if self.disk:
+                keys.update(self.disk.keys())
+            for key in keys:
+                cbase = key.split('?')[0].rstrip('/')
+                if self.__affects(cbase, key, base, path, rtype):
+                    self.collections.pop(key, None)
+                    if self.disk:
+                        self.disk.expire(api=key)
+                    self.invalidations += 1
+
+    def __affects(self, cbase, key, base, path, rtype):
+        if '/search' in cbase:
+            # search spans types, keep it only if it's clearly another type
+            types = re.findall(r'resource_type:([A-Za-z0-9]+)', key)
+            return not (rtype and types and rtype not in types)
+        if base.startswith(cbase + '/') or base == cbase:
+            return True
+        if cbase.startswith(base + '/'):
+            # a parent of the collection was modified
+            return True
+        return False
+
+    def getStats(self):
+        with self.lock:
+            return {'collections': len(self.collections),
+                    'objects': sum(len(c.objects) for c in self.collections.values()),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'loads': self.loads,
+                    'invalidations': self.invalidations,
+                    'diskHits': self.diskHits,
+                    'revalidations': self.revalidations,
+                    'stale': self.stale,
+                    'searches': self.searches,
+                    'syncs': self.syncs,
+                    'deltaObjects': self.deltaObjects,
+                    'reconciliations': self.reconciliations}
@@ -5,12 +5,31 @@ import json
 import ssl
 import OpenSSL
 import re
+import urllib.parse
 from datetime import datetime
 
+def luceneEscape(value):
+    '''
+    Returns value as a search/query term matching it literally.  Query
+    syntax characters are backslash escaped, values with whitespace are
+    quoted as a phrase
+    '''
+    value = re.sub(r'([+\-&|!(){}\[\]^"~*?:\\/])', r'\\\1', str(value))
+    if re.search(r'\s', value):
+        value = '"%s"' % value
+    return value
+
 class Nsx_object(object):
     '''
     Base class for all NSX resources
     '''
+    # lookups on these fields are pushed into search/query list APIs
+    searchableFields = ('display_name', 'id', 'path')
+    # longest search/query URL built by resolvePaths()
+    searchUrlLimit = 4000
+    # included_fields for lookups that only need to identify an object
+    lookupFields = ('id', 'display_name', 'path', 'resource_type',
+                    '_last_modified_time', '_revision')
     def __init__(self, mp, listApi=None, detailApi=None,
                  domain='default',
                  site='default',
@@ -33,7 +52,7 @@ class Nsx_object(object):
         result={}
         resultCount = None
         while firstLoop or cursor:
-            fistLoop = False
+            firstLoop = False
             if '?' in api:
                 url = '%s&cursor=%s' % (api,cursor) if cursor else api
             else:
@@ -87,10 +106,11 @@ class Nsx_object(object):
     
     def list(self, api=None, brief=False, display=True, 
              removeSearch=False, searchFields=['status'],
-             header=None):
+             header=None, includedFields=None):
         '''
         Returns of a list of NSX objects with api.  The return result will combine
         multipage results into one
+        includedFields - list of fields to return, e.g. ['id','display_name','path']
         '''
         if not api:
             if self.listApi:
@@ -98,6 +118,8 @@ class Nsx_object(object):
             else:
                 print("Calling list() without providing API")
                 return None
+        if includedFields:
+            api = self.pageApi(api=api, includedFields=includedFields)
         r = self.__pageHandler(api=api)
         if removeSearch and '/search/query' in api:
             r = self.removeStatusFromSearchList(data=r, fields=searchFields)
@@ -106,11 +128,266 @@ class Nsx_object(object):
             self.jsonPrint(data=r, brief=brief, header=header)
         return r
         
+    def pageApi(self, api, cursor=None, pageSize=None, includedFields=None):
+        '''
+        Returns api with the paging and projection query parameters added
+        '''
+        params = []
+        if pageSize:
+            params.append('page_size=%d' % pageSize)
+        if includedFields:
+            params.append('included_fields=%s' % ','.join(includedFields))
+        if cursor:
+            params.append('cursor=%s' % cursor)
+        if not params:
+            return api
+        return '%s%s%s' % (api, '&' if '?' in api else '?', '&'.join(params))
+
+    def iterList(self, api=None, pageSize=1000, includedFields=None, stream=False,
+                 removeSearch=False, searchFields=['status']):
+        '''
+        Generator that yields the objects of api, default self.listApi, as
+        each page arrives, following cursors.  Stop iterating to avoid
+        downloading the rest of the collection
+        pageSize - objects per page, 1000 is the NSX maximum
+        includedFields - list of fields to return, e.g. ['id','display_name','path']
+        stream - if True, objects are decoded and yielded as they arrive
+                 from the socket instead of a page at a time
+        '''
+        if not api:
+            api = self.listApi
+        if not api:
+            print("Calling iterList() without providing API")
+            return
+        cursor = None
+        while True:
+            url = self.pageApi(api=api, cursor=cursor, pageSize=pageSize,
+                               includedFields=includedFields)
+            if stream:
+                envelope = {}
+                items = self.mp.getStream(api=url, envelope=envelope)
+            else:
+                envelope = self.mp.get(api=url, verbose=False, trial=False)
+                items = envelope.get('results', [])
+            count = 0
+            for item in items:
+                if removeSearch and '/search/query' in api:
+                    for f in searchFields:
+                        item.pop(f, None)
+                count += 1
+                yield item
+            if (count == 0 or 'cursor' not in envelope or
+                str(envelope['cursor']) == str(envelope.get('result_count'))):
+                return
+            cursor = envelope['cursor']
+
+    def streamList(self, api=None, removeSearch=False, searchFields=['status']):
+        '''
+        Generator that yields the objects of api, default self.listApi, one
+        at a time as they are decoded from the response, following cursors
+        across pages.  Memory use stays flat regardless of inventory size
+        '''
+        return self.iterList(api=api, stream=True, removeSearch=removeSearch,
+                             searchFields=searchFields)
+
+    def printStream(self, api=None, brief=False):
+        '''
+        Print the objects from streamList() as they arrive
+        '''
+        if brief:
+            print("%30s %30s %-s" %("name","id","path"))
+            print("%30s %30s %-s" %("----------","----------", "----------"))
+        for i in self.streamList(api=api):
+            if brief:
+                print("%30s %30s %-s" %(i.get('display_name'),
+                                        i.get('id'),
+                                        i['path'] if 'path' in i.keys() else "-"))
+            else:
+                print(json.dumps(i,indent=4))
+
+    async def listAsync(self, api=None, removeSearch=False, searchFields=['status']):
+        '''
+        Coroutine version of list() for use with connections.AsyncNsxConnect.
+        Multipage results are merged into one
+        '''
+        if not api:
+            api = self.listApi
+        if not api:
+            print("Calling listAsync() without providing API")
+            return None
+        cursor = None
+        result = {}
+        while True:
+            if cursor:
+                url = '%s%scursor=%s' % (api, '&' if '?' in api else '?', cursor)
+            else:
+                url = api
+            r = await self.mp.get(api=url, verbose=False, trial=False)
+            if result:
+                result['results'].extend(r['results'])
+            else:
+                result = r
+            if 'cursor' not in r or str(r['cursor']) == str(result.get('result_count')):
+                break
+            cursor = r['cursor']
+        if removeSearch and '/search/query' in api:
+            result = self.removeStatusFromSearchList(data=result, fields=searchFields)
+        return result
+
+    def searchApi(self, api, field, value):
+        '''
+        Returns the search/query api with a term matching field to value
+        added, None if api is not a search query
+        '''
+        base, _, query = api.partition('?')
+        if not base.endswith('/search/query'):
+            return None
+        params = urllib.parse.parse_qsl(query)
+        queries = [q for k,q in params if k == 'query']
+        if len(queries) != 1:
+            return None
+        params = [('query', '(%s) AND %s:%s' % (queries[0], field, luceneEscape(value)))] + [
+            (k,v) for k,v in params if k != 'query']
+        return '%s?%s' % (base, urllib.parse.urlencode(params, quote_via=urllib.parse.quote,
+                                                       safe=':*'))
+
+    def searchByField(self, api, field, value, removeSearch=True):
+        '''
+        Returns the first object of the search api whose field is exactly
+        value, asking the manager to filter by field.  The search itself may
+        also return partial matches, they are skipped
+        '''
+        for o in self.iterList(api=self.searchApi(api=api, field=field, value=value),
+                               removeSearch=removeSearch):
+            if o.get(field) == value:
+                return o
+        return None
+
+    def searchContext(self):
+        '''
+        search/query parameters limiting a search to the project of mp
+        '''
+        if not self.mp.project:
+            return []
+        return [('context', 'projects:/orgs/%s/projects/%s' %(self.mp.org, self.mp.project))]
+
+    def resolvePaths(self, resourceType, names, field='display_name', listApi=None):
+        '''
+        Returns a dictionary of name to path for the objects of resourceType
+        whose field matches names.  The names are OR'd into as few
+        search/query requests as the URL length allows, within the project
+        of mp.  If listApi, the collection of the objects, isn't a search
+        query the names are looked up in it instead, it's listed once
+        through the inventory and has no search index lag.  Raises
+        ValueError listing every name that wasn't found
+        '''
+        if listApi and not listApi.partition('?')[0].endswith('/search/query'):
+            found = {}
+            for n in dict.fromkeys(names):
+                o = self.__lookup(api=listApi, field=field, value=n,
+                                  includedFields=self.lookupFields)
+                if o:
+                    found[n] = o['path']
+            missing = [n for n in dict.fromkeys(names) if n not in found]
+            if missing:
+                raise ValueError("%s not found: %s" % (resourceType, ', '.join(missing)))
+            return found
+
+        context = self.searchContext()
+        api = self.pageApi(api='/policy/api/v1/search/query?query=resource_type:%s'
+                           % resourceType, includedFields=self.lookupFields)
+        if context:
+            api = '%s&%s' % (api, urllib.parse.urlencode(context))
+        found = {}
+        pending = []
+        if names and self.mp.inventory and self.mp.inventory.disk:
+            # collections kept on disk are cheaper to revalidate than to search
+            self.mp.inventory.collection(api=api,
+                                         loader=lambda: self.iterList(api=api,
+                                                                      removeSearch=True))
+        for n in dict.fromkeys(names):
+            known, obj = (self.mp.inventory.lookup(api=api, field=field, value=n)
+                          if self.mp.inventory else (False, None))
+            if obj:
+                found[n] = obj['path']
+            elif not known:
+                pending.append(n)
+
+        chunks = []
+        terms = []
+        for n in pending:
+            term = '%s:%s' % (field, luceneEscape(n))
+            # rough size of the URL encoded query with this term added
+            size = len(urllib.parse.quote(' OR '.join(terms + [term]))) + len(api) + 64
+            if terms and size > self.searchUrlLimit:
+                chunks.append(terms)
+                terms = []
+            terms.append(term)
+        if terms:
+            chunks.append(terms)
+
+        wanted = set(pending)
+        for terms in chunks:
+            url = '%s?%s' % (api.partition('?')[0], urllib.parse.urlencode(
+                [('query', 'resource_type:%s AND (%s)' % (resourceType, ' OR '.join(terms))),
+                 ('included_fields', ','.join(self.lookupFields))] + context,
+                quote_via=urllib.parse.quote, safe=':*,'))
+            matched = []
+            for o in self.iterList(api=url, removeSearch=True):
+                if o.get(field) in wanted and o[field] not in found:
+                    found[o[field]] = o['path']
+                    matched.append(o)
+            if self.mp.inventory:
+                self.mp.inventory.remember(api=api, objects=matched)
+
+        missing = [n for n in dict.fromkeys(names) if n not in found]
+        if missing:
+            raise ValueError("%s not found: %s" % (resourceType, ', '.join(missing)))
+        return found
+
+    def __lookup(self, api, field, value, data=None, removeSearch=True, ignorecase=False,
+                 includedFields=None):
+        '''
+        Returns the first object in data, or else in the collection of api,
+        whose field matches value.  Uses the shared inventory index if
+        enabled.  Search APIs are filtered by the manager for display_name,
+        id and path, other APIs are listed until the first match
+        '''
+        if includedFields and not data:
+            if field not in includedFields:
+                includedFields = list(includedFields) + [field]
+            api = self.pageApi(api=api, includedFields=includedFields)
+        search = None
+        if (not data and not ignorecase and field in self.searchableFields and
+            self.searchApi(api=api, field=field, value=value)):
+            search = lambda: self.searchByField(api=api, field=field, value=value,
+                                                removeSearch=removeSearch)
+        if data:
+            objects = data['results']
+        elif self.mp.inventory and removeSearch:
+            return self.mp.inventory.find(api=api, field=field, value=value,
+                                          ignorecase=ignorecase, search=search,
+                                          loader=lambda: self.iterList(api=api,
+                                                                       removeSearch=True))
+        elif search:
+            return search()
+        else:
+            objects = self.iterList(api=api, removeSearch=removeSearch)
+        for o in objects:
+            if field not in o:
+                continue
+            if not ignorecase and o[field] == value:
+                return o
+            elif ignorecase and o[field].lower() == value.lower():
+                return o
+        return None
+
     def findByName(self, name, field='display_name', removeSearch=True,
                    api=None, data=None, display=True,brief=False, ignorecase=False,
-                   detailApi=None):
+                   detailApi=None, includedFields=None):
         '''
         Find an nsxobject by display_name
+        includedFields - only return these fields, e.g. self.lookupFields
         '''
         if not data:
             if not api:
@@ -119,15 +396,9 @@ class Nsx_object(object):
             if not api:
                 print ("Calling list with no API specified")
                 return None
-            data = self.list(api=api,display=False, removeSearch=removeSearch)
-        obj = None
-        for o in data['results']:
-            if not ignorecase and o[field] == name:
-                obj = o
-                break
-            elif ignorecase and o[field].lower() == name.lower():
-                obj = 0
-                break
+        obj = self.__lookup(api=api, field=field, value=name, data=data,
+                            removeSearch=removeSearch, ignorecase=ignorecase,
+                            includedFields=includedFields)
             
         if obj and display:
             if brief:
@@ -139,24 +410,71 @@ class Nsx_object(object):
                 self.jsonPrint(data=obj)
         return obj
     
-    def findById(self, id, api=None, data=None, display=True,brief=False, removeSearch=True):
+    def fetchById(self, id, api=None):
+        '''
+        GET one object by id from detailApi/<id>, from <api>/<id> for
+        plain list APIs, or by policy path if id starts with /.
+        Returns (found, obj), found is False if the object couldn't be
+        fetched directly and the collection must be searched
+        '''
+        if id.startswith('/'):
+            path = id
+            if self.mp.project:
+                # normalizeGmLmApi() adds the org/project prefix back
+                path = re.sub(r'^/orgs/[^/]+/projects/[^/]+(?=/)', '', path)
+            url = path if path.startswith('/policy/api/') else '/policy/api/v1%s' % path
+            authoritative = True
+        elif self.detailApi and (not api or api == self.listApi):
+            url = '%s/%s' % (self.detailApi, id)
+            authoritative = True
+        elif api and '?' not in api and '/search/' not in api:
+            # not every list API has a detail API below it
+            url = '%s/%s' % (api, id)
+            authoritative = False
+        else:
+            return (False, None)
+        try:
+            r = self.mp.get(api=url, verbose=False, codes=[200, 404])
+        except ValueError:
+            return (False, None)
+        if 'error_code' in r:
+            return (authoritative, None)
+        if not id.startswith('/') and r.get('id') != id:
+            return (False, None)
+        return (True, r)
+
+    def findByPath(self, path, display=True):
+        '''
+        Find a policy object by path with a single GET
+        '''
+        found, obj = self.fetchById(id=path)
+        if obj and display:
+            self.jsonPrint(data=obj)
+        return obj
+
+    def findById(self, id, api=None, data=None, display=True,brief=False, removeSearch=True,
+                 includedFields=None):
         '''
-        Find an nsxobject by id
+        Find an nsxobject by id.  Unless data is given the object is
+        fetched directly with fetchById(), the collection is only searched
+        if that's not possible
         '''
         if not data:
             if not api:
                 if self.listApi:
                     api=self.listApi
-            if not api:
+            if not api and not id.startswith('/'):
                 print ("Calling list with no API specified")
                 return None
-        data = self.list(api=api,display=False, removeSearch=removeSearch)
-        obj = None
-
-        for o in data['results']:
-            if o['id'] == id:
-                obj = o
-                break
+            found, obj = (self.mp.inventory.lookup(api=api, field='id', value=id)
+                          if self.mp.inventory and api else (False, None))
+            if not found:
+                found, obj = self.fetchById(id=id, api=api)
+        else:
+            found = False
+        if not found:
+            obj = self.__lookup(api=api, field='id', value=id, data=data,
+                                removeSearch=removeSearch, includedFields=includedFields)
         if obj and display:
             if brief:
                 print("%d. Name: %s" %(i,obj['display_name']))
@@ -179,7 +497,8 @@ class Nsx_object(object):
         '''
         Return the ID of an object found by display_name
         '''
-        r = self.findByName(name=name, api=api,data=data,display=False)
+        r = self.findByName(name=name, api=api,data=data,display=False,
+                            includedFields=self.lookupFields)
         if r:
             return r['id']
         
@@ -190,7 +509,8 @@ class Nsx_object(object):
         if not api:
             api=self.listApi
 
-        obj = self.findByName(api=api,name=name, data=data, display=False)
+        obj = self.findByName(api=api,name=name, data=data, display=False,
+                              includedFields=self.lookupFields)
         if obj:
             if display:
                 print(obj['path'])
@@ -204,7 +524,8 @@ class Nsx_object(object):
         if not api:
             api=self.listApi
 
-        obj = self.findById(api=api,id=id,data=data, display=False)
+        obj = self.findById(api=api,id=id,data=data, display=False,
+                            includedFields=self.lookupFields)
         if obj:
             if display:
                 print(obj['path'])
@@ -991,12 +1312,15 @@ class Edge(Nsx_object):
             
     def getRTeps(self, names=None, display=True):
         edges=self.list(api='/api/v1/transport-nodes?node_types=EdgeNode', display=False)
-        for e in edges['results']:
-            if names and e['display_name'] not in names:
-                continue
+        edges=[e for e in edges['results']
+               if not names or e['display_name'] in names]
+        states=self.mp.mapGet(apis=['/api/v1/transport-nodes/%s/state' % e['id']
+                                    for e in edges])
+        for e,data in zip(edges, states):
             print("Edge %s:" %e['display_name'])
-            api='/api/v1/transport-nodes/%s/state' % e['id']
-            data=self.mp.get(api=api, verbose=False, display=False)
+            if isinstance(data, Exception):
+                print("   Error retrieving state: %s" %data)
+                continue
             if not 'remote_tunnel_endpoint_state' in data:
                 print("   None")
                 continue
@@ -2301,10 +2625,16 @@ class Tier0(Nsx_object):
             print("Invalid Tier0 Gateway or realization error: %s" %name)
             return None
 
-        for n in status['per_node_status']:
-            print("==>Output for Edge TN %s" %n['transport_node_id'])
-            api=mpApi+'/routing/'+rtype+'?transport_node_id=%s&source=realtime' %n['transport_node_id']
-            r = self.mp.get(api=api,verbose=True)
+        nodes=[n['transport_node_id'] for n in status['per_node_status']]
+        apis=[mpApi+'/routing/'+rtype+'?transport_node_id=%s&source=realtime' %n
+              for n in nodes]
+        tables=self.mp.mapGet(apis=apis)
+        for n,api,r in zip(nodes, apis, tables):
+            print("==>Output for Edge TN %s" %n)
+            print("API: GET %s" %api)
+            if isinstance(r, Exception):
+                print("Error: %s" %r)
+                continue
             self.jsonPrint(r)
             
     def getPim(self, t0, locale='default', display=True):
@@ -3347,17 +3677,30 @@ class Segments(Nsx_object):
 
         P = SegmentPort(mp=self.mp, segmentPath=sp)
         ports = P.list(display=False)['results']
+        matched = []
         for i in ports:
             if portName:
                 if glob and portName in i['display_name']:
-                    P.tag(portPath=i['path'], tagSpec=tagSpec, portData=i,replace=replace)
+                    matched.append(i)
                 elif portName == i['display_name']:
-                    P.tag(portPath=i['path'], tagSpec=tagSpec, portData=i,replace=replace)
+                    matched.append(i)
                     break
                 else:
                     continue
             else:
-                P.tag(portPath=i['path'], tagSpec=tagSpec, portData=i,replace=replace)
+                matched.append(i)
+
+        items = []
+        for i in matched:
+            data = P.tagData(portData=i, tagSpec=tagSpec, replace=replace)
+            print("path: %s, name: %s, tags: %s" %(i['path'], i['display_name'], data['tags']))
+            items.append(('/policy/api/v1'+i['path'], data))
+        results = self.mp.mapPatch(items=items, codes=[200])
+        for (api,data),r in zip(items, results):
+            if isinstance(r, Exception):
+                print("API: PATCH %s failed: %s" %(api, r))
+            else:
+                print("API: PATCH %s result code: %d" %(api, r.status_code))
 
     def deletePort(self, segmentName, portName=None, portPath=None, glob=False):
         print("looking for %s" %segmentName)
@@ -3413,11 +3756,12 @@ class SegmentPort(Nsx_object):
         api=self.listApi + '/%s' % name.replace(' ', '_')
         self.mp.patch(api=api,data=data,verbose=True,codes=[200])
 
-    def tag(self, portPath, portData, tagSpec,  replace):
-        tags = None
+    def tagData(self, portData, tagSpec, replace):
+        '''
+        Update portData with the tags from tagSpec and return it
+        '''
         T = Tags(mp=self.mp)
         tags=T.createFromSpec(spec=tagSpec)
-        print("path: %s, name: %s, tags: %s" %(portPath, portData['display_name'], tags))
         if 'tags' in portData.keys():
             if replace:
                 portData['tags'] = tags
@@ -3425,6 +3769,12 @@ class SegmentPort(Nsx_object):
                 portData['tags'] += tags
         else:
             portData['tags'] = tags
+        return portData
+
+    def tag(self, portPath, portData, tagSpec,  replace):
+        portData = self.tagData(portData=portData, tagSpec=tagSpec, replace=replace)
+        print("path: %s, name: %s, tags: %s" %(portPath, portData['display_name'],
+                                               portData['tags']))
         api='/policy/api/v1'+portPath
         self.mp.patch(api=api,data=portData,verbose=True,codes=[200])
         
@@ -4136,32 +4486,20 @@ class Group(Nsx_object):
             expr.append(data)
             
     def __handleSegments(self, segments, expr, conjunction):
-        s = Segments(mp=self.mp)
         data={}
         data['resource_type'] = 'PathExpression'
-        data['paths'] = []
-        for n in segments:
-            curS = s.getPathByName(name=n, display=False)
-            if not curS:
-                raise ValueError("Segment %s not found" %n)
-            data['paths'].append(curS)
+        paths = self.resolvePaths(resourceType='Segment', names=segments)
+        data['paths'] = [paths[n] for n in segments]
         if len(data['paths']) == 0:
             raise ValueError("No valid segments found to add, spec: %s:" %segments)
         self.__addToExpressions(expr=expr, data=data,
                                 conjunction=conjunction)
 
     def __handleHosts(self, hosts, expr, conjunction):
-        s = HostTransportNode(mp=self.mp)
-
         data={}
         data['resource_type'] = 'PathExpression'
-        data['paths'] = []
-        
-        for h in hosts:
-            host = s.getPathByName(name=h, display=False)
-            if not host:
-                raise ValueError("Host %s not found" %h)
-            data['paths'].append(host)
+        paths = self.resolvePaths(resourceType='HostTransportNode', names=hosts)
+        data['paths'] = [paths[h] for h in hosts]
         if len(data['paths']) == 0:
             raise ValueError("No hosts found to be added to group: %s" %hosts)
         self.__addToExpressions(expr=expr, data=data, conjunction=conjunction)
@@ -4170,14 +4508,10 @@ class Group(Nsx_object):
     def __handleGroups(self, groups, expr, conjunction):
         data={}
         data['resource_type'] ='PathExpression'
-        data['paths'] = []
-        for n in groups:
-            curG = self.getPathByName(name=n, display=False)
-            if not curG:
-                raise ValueError("Group %s not found" %g)
-            data['paths'].append(curG)
+        paths = self.resolvePaths(resourceType='Group', names=groups)
+        data['paths'] = [paths[n] for n in groups]
         if len(data['paths']) == 0:
-            raise ValueError("No valid groups found to add, spec: %s:" %segments)
+            raise ValueError("No valid groups found to add, spec: %s:" %groups)
         self.__addToExpressions(expr=expr, data=data,
                                 conjunction=conjunction)
 
@@ -4524,14 +4858,12 @@ class SecurityPolicy(Nsx_object):
             data['sequence_number'] = sequence
         data['connectivity_strategy'] = connectivity
         if scope:
-            G = Group(mp=self.mp)
-            data['scope']=[]
-            for g in scope:
-                p = G.getPathByName(name=g, display=False)
-                if not p:
-                    print("Group %s not found" % g)
-                    return None
-                data['scope'].append(p)
+            try:
+                paths = self.resolvePaths(resourceType='Group', names=scope)
+            except ValueError as e:
+                print(e)
+                return None
+            data['scope'] = [paths[g] for g in scope]
 
         api='/policy/api/v1/infra/domains/%s/security-policies/%s' %(domain,name)
         #api="%s?action=revise&operation=insert_bottom" %api
@@ -4722,6 +5054,21 @@ class Rule(Nsx_object):
         
         self.listApi='/policy/api/v1%s/rules' % self.policyPath
 
+    def __groupNames(self, specs):
+        '''
+        Group names from domain:name or name specs, None if ANY
+        '''
+        names = []
+        for spec in specs:
+            if ':' in spec:
+                dom,gname=spec.split(":")
+            else:
+                gname=spec
+            if gname.upper()=='ANY':
+                return None
+            names.append(gname)
+        return names
+
     def config(self, name, action, 
                src=["ANY"], dst=["ANY"],
                srcNegate=False, dstNegate=False,
@@ -4730,7 +5077,6 @@ class Rule(Nsx_object):
                sequence=None, scope=None):
 
 
-        policydomain=self.domain
         policyPath = self.policyPath
         fullApi='/policy/api/v1%s/rules/%s' %(policyPath,name)
         data={}
@@ -4746,60 +5092,56 @@ class Rule(Nsx_object):
         if log:
             data['logged']  = True
         # group format:  domain:name or name, if just name, domain is same as Rule
-        data['destination_groups'] = []
-        for d in dst:
-            if ':' in d:
-                dom,gname=d.split(":")
-            else:
-                dom=policydomain
-                gname=d
-            if gname.upper()=='ANY':
-                data['destination_groups'] = ['ANY']
+        dstNames = self.__groupNames(dst)
+        srcNames = self.__groupNames(src)
+        svcNames = []
+        for svc in services:
+            if svc.upper() == 'ANY':
+                svcNames = None
                 break
-            grp = Group(mp=self.mp, domain=dom)
-            gpath=grp.getPathByName(name=gname, display=False)
-            if not gpath:
-                print("Path for destination group %s not found in domain %s " %(gname, dom))
-                return None
-            data['destination_groups'].append(gpath)
+            svcNames.append(svc)
+
+        # applied-to format: type:domain:name
+        scopeSpecs = []
+        if scope and "/gateway-policies/" not in self.policyPath:
+            for i in scope:
+                if i=='ANY':
+                    scopeSpecs.append(('any', 'ANY'))
+                    break
+                sType,sDomain,sValue=i.split(':')
+                scopeSpecs.append((sType.strip().lower(), sValue))
+
+        # resolve all names with one search per resource type
+        try:
+            groupPaths = self.resolvePaths(resourceType='Group',
+                                           names=(dstNames or []) + (srcNames or []) +
+                                           [v for t,v in scopeSpecs if t == 'group'])
+            svcPaths = self.resolvePaths(resourceType='Service', names=svcNames or [],
+                                         listApi=Service(mp=self.mp).listApi)
+            segPaths = self.resolvePaths(resourceType='Segment',
+                                         names=[v for t,v in scopeSpecs if t == 'segment'])
+        except ValueError as e:
+            print(e)
+            return None
 
+        if dstNames is None:
+            data['destination_groups'] = ['ANY']
+        else:
+            data['destination_groups'] = [groupPaths[n] for n in dstNames]
         if dstNegate:
             data['destination_excluded'] = True
 
-        data['source_groups'] = []
-        for s in src:
-            if ':' in s:
-                dom,gname=s.split(":")
-            else:
-                dom=policydomain
-                gname=s
-            if gname.upper()=='ANY':
-                data['source_groups'] = ['ANY']
-                break
-            grp = Group(mp=self.mp, domain=dom)
-            gpath=grp.getPathByName(name=gname, display=False)
-            if not gpath:
-                print("Path for source group %s not found in domain %s " %(gname, dom))
-                return None
-            data['source_groups'].append(gpath)
-
+        if srcNames is None:
+            data['source_groups'] = ['ANY']
+        else:
+            data['source_groups'] = [groupPaths[n] for n in srcNames]
         if srcNegate:
             data['source_excluded'] = True
 
-
-        data['services'] = []
-
-        S = Service(mp=self.mp)
-        for svc in services:
-            if svc.upper() == 'ANY':
-                data['services'] = ['ANY']
-                break
-            spath = S.getPathByName(name=svc, display=False)
-            if not spath:
-                print("Path for service %s not found" %svc)
-                return
-            data['services'].append(spath)
-            
+        if svcNames is None:
+            data['services'] = ['ANY']
+        else:
+            data['services'] = [svcPaths[n] for n in svcNames]
             
         if scope:
             if "/gateway-policies/" in self.policyPath:
@@ -4808,31 +5150,13 @@ class Rule(Nsx_object):
                     data['scope'].append(i)
             else:
                 data['scope']=[]
-                for i in scope:
-                    if i=='ANY':
+                for sType,sValue in scopeSpecs:
+                    if sType == 'any':
                         data['scope'].append('ANY')
-                        break
-                    sType,sDomain,sValue=i.split(':')
-                    if sDomain.strip()=='':
-                        sDomain=policydomain
-                    else:
-                        sDomain = sDomain.strip()
-                    if sType.strip().lower() == 'group':
-                        G = Group(mp=self.mp, domain=sDomain)
-                        path=G.getPathByName(name=sValue, display=False)
-                        if not path:
-                            print("Path not found for group %s for applied-to spec: %s"
-                                  %(sValue,i))
-                            return
-                        data['scope'].append(path)
-                    elif sType.strip().lower() == 'segment':
-                        S = Segments(mp=self.mp)
-                        path = S.getPathByName(name=sValue, display=False)
-                        if not path:
-                            print("Path not found for segment %s for applied-to spec: %s"
-                                  %(sValue, i))
-                            return
-                        data['scope'].append(path)
+                    elif sType == 'group':
+                        data['scope'].append(groupPaths[sValue])
+                    elif sType == 'segment':
+                        data['scope'].append(segPaths[sValue])
 
 
         self.mp.patch(api=fullApi,data=data,verbose=True,codes=[200])
@@ -5951,16 +6275,14 @@ class TransportNode(Nsx_object):
                                         
 
     def findByNodeId(self,id,display=True):
-        nodes = self.list(display=False)
-        if nodes['result_count'] == 0:
+        # transport node ids are the node ids since NSX 3.0, try a direct GET first
+        n = self.findById(id=id, display=False)
+        if not n or n.get('node_id', n['id']) != id:
+            n = self.findByName(name=id, field='node_id', display=False)
+        if n:
             if display:
-                print("No transport nodes defined in MP")
-            return None
-        for n in nodes['results']:
-            if n['node_id'] == id:
-                if display:
-                    self.json_print(data=n,convert=False)
-                return n
+                self.jsonPrint(data=n)
+            return n
         if display:
             print("No transport node found with node id: %s" % id)
         return None
@@ -6026,10 +6348,13 @@ class TransportNode(Nsx_object):
             nodes={'results': [node]}
         else:
             nodes=self.list(display=False)
-        for tn in nodes['results']:
-            api = '/api/v1/transport-nodes/%s/state' %tn['id']
-            data=self.mp.get(api=api, verbose=None, display=None)
+        states=self.mp.mapGet(apis=['/api/v1/transport-nodes/%s/state' %tn['id']
+                                    for tn in nodes['results']])
+        for tn,data in zip(nodes['results'], states):
             print("TN %s" %tn['display_name'])
+            if isinstance(data, Exception):
+                print("   Error retrieving state: %s" %data)
+                continue
             if 'host_switch_states' in data and 'endpoints' in data['host_switch_states'][0]:
                 for n in data['host_switch_states'][0]['endpoints']:
                     print("   %s / %s gw %s" %(n['ip'], n['subnet_mask'],
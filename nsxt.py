@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
 import getpass
+import atexit
+import time
 import json
+import gzip
+import sys
 import argparse
 import connections
 import nsxobjects
+import hapi
+import desiredstate
+import teardown
 
 def parseParameters():
 
@@ -17,8 +24,34 @@ def parseParameters():
         'CertFile can be in single .p12 format or commma serperated .crt,.key files. '
         'E.g.: "myCert.p12" OR "myCert.crt,myCert.key"')
     parser.add_argument('--safe', action='store_true', help='Do not send non-safe http requests (POST, PUT, DELETE)')
+    parser.add_argument('--rate', type=float, default=None,
+                        help='Max API requests per second to the manager, default no limit')
+    parser.add_argument('--max-retries', type=int, default=3, dest='maxRetries',
+                        help='Times to retry a request rejected with 429/503, default 3')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Adjust requests in flight from observed manager latency')
+    parser.add_argument('--read-nodes', default=None, dest='readNodes',
+                        choices=['round-robin', 'least-latency'],
+                        help='Spread reads across the manager cluster nodes')
+    parser.add_argument('--stats', action='store_true',
+                        help='Print API request statistics when done')
     parser.add_argument('--cookie', default=None,
                         help="Authenticate using session cookie file")
+    parser.add_argument('--session-auth', action='store_true', dest='sessionAuth',
+                        help="Use Basic Auth once to create a session and use the "
+                        "session for all requests")
+    parser.add_argument('--session-cache', action='store_true', dest='sessionCache',
+                        help="Like --session-auth, and keep the session in a per-manager "
+                        "cache file for reuse by later invocations")
+    parser.add_argument('--version-ttl', type=int, default=86400, dest='versionTtl',
+                        help="Seconds to cache the manager version on disk, 0 to always "
+                        "refresh in the background, default 86400")
+    parser.add_argument('--inventory-cache', action='store_true', dest='inventoryCache',
+                        help="Keep listed collections in an on-disk cache shared by "
+                        "invocations, revalidated with one request per collection")
+    parser.add_argument('--inventory-ttl', type=int, default=0, dest='inventoryTtl',
+                        help="Seconds a cached collection is used without revalidation, "
+                        "default 0")
     parser.add_argument('--policysite', default='default',
                         help="Site - default is: default")
     parser.add_argument('--enforcement', default='default',
@@ -2715,6 +2748,80 @@ def parseParameters():
     fed.add_argument('--name', required=True,
                      help="Name of the Active Site")
     
+    cacheSpace = subparsers.add_parser('cache')
+    cacheNs = cacheSpace.add_subparsers(dest='cache', required=True)
+    cache = cacheNs.add_parser('warm')
+    cache.add_argument('--objects', nargs='+',
+                       default=['segment', 'group', 'service', 'tier0', 'tier1', 'tz', 'tn'],
+                       choices=['segment', 'group', 'service', 'tier0', 'tier1', 'tz',
+                                'tn', 'vm', 'edgecluster', 'ippool'],
+                       help="Collections to list into the inventory cache")
+    cache = cacheNs.add_parser('sync')
+    cache.add_argument('--api', default=None,
+                       help="Only sync this list API")
+    cache.add_argument('--reconcile', action='store_true',
+                       help="Always check for deleted objects by listing ids")
+    cache.add_argument('--reconcile-after', type=int, default=3600, dest='reconcileAfter',
+                       help="Seconds between checks for deleted objects, default 3600")
+    cache = cacheNs.add_parser('show')
+    cache.add_argument('--all', action='store_true',
+                       help="Show all managers, users, versions and projects")
+    cache = cacheNs.add_parser('expire')
+    cache.add_argument('--api', default=None,
+                       help="Only expire this list API")
+    cache.add_argument('--all', action='store_true',
+                       help="Expire all managers, users, versions and projects")
+
+    exportSpace = subparsers.add_parser('export',
+                                        help="Stream the policy tree to a NDJSON file with "
+                                        "H-API GET requests, one object with its path per line")
+    exportSpace.add_argument('-o', '--output', default='-',
+                             help="Output file, default stdout.  Compressed with gzip "
+                             "if it ends with .gz")
+    exportSpace.add_argument('--gzip', action='store_true',
+                             help="Compress the output with gzip")
+    exportSpace.add_argument('--types', nargs='+', default=None,
+                             help="Only export these resource_types, e.g. Segment Group")
+    exportSpace.add_argument('--filter', nargs='+', default=[None],
+                             help="H-API filter, e.g. 'Type-Domain|Group', one GET per filter")
+    exportSpace.add_argument('--base-path', default=None, dest='basePath',
+                             help="Only export the subtree below this policy path")
+
+    for name in ['plan', 'apply']:
+        stateSpace = subparsers.add_parser(name,
+                                           help="%s the policy objects described in a "
+                                           "desired state file" %name.capitalize())
+        stateSpace.add_argument('-f', '--file', required=True, dest='specFile',
+                                help="YAML (needs PyYAML) or JSON desired state file")
+        stateSpace.add_argument('--verbose', action='store_true',
+                                help="Also show unchanged objects and the API calls")
+        stateSpace.add_argument('--max-payload', type=int, default=1000000,
+                                dest='maxPayload',
+                                help="Max bytes per H-API request")
+        stateSpace.add_argument('--parallel', type=int, default=0,
+                                help="Apply in dependency order with this many requests "
+                                "in flight instead of H-API batches")
+
+    teardownSpace = subparsers.add_parser('teardown',
+                                          help="Delete policy objects and what's nested "
+                                          "below them, leaves first")
+    teardownSpace.add_argument('--path', default=None, dest='rootPath',
+                               help="Delete this policy path and everything below it")
+    teardownSpace.add_argument('--tag', default=None,
+                               help="Delete objects with this tag, scope:tag or tag")
+    teardownSpace.add_argument('--name', default=None,
+                               help="Delete objects whose display_name matches this "
+                               "pattern, e.g. 'lab-*'")
+    teardownSpace.add_argument('--types', nargs='+', default=None,
+                               help="Only consider these resource_types")
+    teardownSpace.add_argument('--cascade', action='store_true',
+                               help="Also delete the objects referring to the selected ones")
+    teardownSpace.add_argument('--parallel', type=int, default=8,
+                               help="DELETE requests in flight, default 8")
+    teardownSpace.add_argument('--dry-run', action='store_true', dest='dryRun',
+                               help="Only show the delete waves")
+    teardownSpace.add_argument('--verbose', action='store_true')
+
     searchSpace = subparsers.add_parser('search')
     searchNs = searchSpace.add_subparsers(dest='search', required=True)
     search = searchNs.add_parser('lookup')
@@ -2903,6 +3010,8 @@ def createCommonParsers(parser, names=[], arguments=None):
     if 'list' in names:
         p = parser.add_parser('list')
         p.add_argument('--brief', action='store_true')
+        p.add_argument('--stream', action='store_true',
+                       help='Print objects as they arrive instead of after the whole list')
         if arguments:
             for i in arguments:
                 arg='--'+i
@@ -2996,7 +3105,10 @@ def commonHandlers(obj, argsNs, subNs, args, debug=False):
             obj.getPathByName(name=args.name,data=d,display=True)
 
     elif subNs == 'list':
-        obj.list(display=True, brief=args.brief)
+        if getattr(args, 'stream', False) and obj.listApi:
+            obj.printStream(brief=args.brief)
+        else:
+            obj.list(display=True, brief=args.brief)
     elif subNs == 'find' or subNs == 'show':
         if not args.name and not args.id:
             print("Must provide either name or id, ID takes precedence")
@@ -3187,7 +3299,18 @@ def main():
                               domain=args.region,
                               timeout=args.sessiontimeout,
                               org=args.org,
-                              project=args.project)
+                              project=args.project,
+                              rate=args.rate,
+                              maxRetries=args.maxRetries,
+                              adaptive=args.adaptive,
+                              readNodes=args.readNodes,
+                              sessionAuth=args.sessionAuth,
+                              sessionCache=args.sessionCache,
+                              versionTtl=args.versionTtl,
+                              inventoryCache=args.inventoryCache or args.ns == 'cache',
+                              inventoryTtl=args.inventoryTtl)
+    if args.stats:
+        atexit.register(lambda: print(json.dumps(mp.getStats(), indent=4)))
 
     if not args.ns:
         print(args)
@@ -3199,6 +3322,128 @@ def main():
         # return here as session is a special case
         return
 
+    if args.ns == 'cache':
+        disk = mp.inventory.disk
+        if argsNs['cache'] == 'warm':
+            mp.inventory.ttl = 0
+            for name in args.objects:
+                obj = createNsxObject(objName=name, mp=mp, args=args)
+                # same projection as getPathByName()/getIdByName()
+                api = obj.pageApi(api=obj.listApi, includedFields=obj.lookupFields)
+                c = mp.inventory.collection(api=api,
+                                            loader=lambda: obj.iterList(api=api,
+                                                                        removeSearch=True))
+                print("%6d %s" %(len(c.objects), c.api))
+        elif argsNs['cache'] == 'sync':
+            for api,changed,removed in mp.inventory.sync(api=args.api,
+                                                         reconcileAfter=args.reconcileAfter,
+                                                         reconcile=args.reconcile):
+                print("%6d changed %6s removed %s" %(changed,
+                                                     'relist' if removed is None else removed,
+                                                     api))
+        elif argsNs['cache'] == 'show':
+            print("%8s %20s %-s" %("objects", "validated", "api"))
+            for c in disk.getCollections(allScopes=args.all):
+                print("%8d %20s %-s" %(c['count'],
+                                       time.strftime('%Y-%m-%d %H:%M:%S',
+                                                     time.localtime(c['validated'])),
+                                       c['api'] if not args.all
+                                       else '%s %s' %(c['scope'], c['api'])))
+        elif argsNs['cache'] == 'expire':
+            api = mp.normalizeGmLmApi(args.api) if args.api else None
+            n = disk.expire(api=api, allScopes=args.all)
+            print("Expired %d collections" %n)
+        return
+
+    if args.ns == 'export':
+        raw = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+        out = raw
+        if args.gzip or args.output.endswith('.gz'):
+            out = gzip.GzipFile(fileobj=raw, mode='wb')
+        n = 0
+        try:
+            for f in args.filter:
+                for item in hapi.exportTree(mp=mp, filter=f, basePath=args.basePath,
+                                            typeFilter=';'.join(args.types) if args.types
+                                            else None,
+                                            types=args.types):
+                    out.write(mp.codec.dumps(item) + b'\n')
+                    n += 1
+        finally:
+            if out is not raw:
+                # writes the gzip trailer, raw stays open
+                out.close()
+            if raw is sys.stdout.buffer:
+                raw.flush()
+            else:
+                raw.close()
+        if args.output != '-':
+            print("Exported %d objects to %s" %(n, args.output))
+        return
+
+    if args.ns in ['plan', 'apply']:
+        try:
+            state = desiredstate.DesiredState(mp=mp,
+                                              spec=desiredstate.loadSpec(args.specFile))
+            changes = state.plan()
+        except ValueError as e:
+            print(e)
+            return
+        desiredstate.printPlan(changes, verbose=args.verbose)
+        if args.ns == 'apply' and args.parallel:
+            try:
+                state.applyParallel(changes=changes, maxWorkers=args.parallel,
+                                    verbose=args.verbose)
+            except ValueError as e:
+                print(e)
+                return
+            for c in changes:
+                if c.get('status') == 'failed':
+                    print("Failed %s: %s" %(c['path'], c['error']))
+                elif c.get('status') == 'skipped':
+                    print("Skipped %s, depends on a failed change" %c['path'])
+            print("Applied %d changes" %len([c for c in changes
+                                              if c.get('status') == 'applied']))
+        elif args.ns == 'apply':
+            state.apply(changes=changes, verbose=args.verbose, maxPayload=args.maxPayload)
+            print("Applied %d changes" %len([c for c in changes
+                                              if c['action'] != 'unchanged']))
+        return
+
+    if args.ns == 'teardown':
+        t = teardown.Teardown(mp=mp, types=args.types)
+        try:
+            selected = t.select(rootPath=args.rootPath, tag=args.tag, name=args.name,
+                                cascade=args.cascade)
+        except ValueError as e:
+            print(e)
+            return
+        try:
+            if args.dryRun:
+                levels = desiredstate.dependencyLevels(t.dependencies(selected))
+            else:
+                waves = t.run(selected=selected, maxWorkers=args.parallel,
+                              verbose=args.verbose)
+        except ValueError as e:
+            print(e)
+            return
+        if args.dryRun:
+            for i,level in enumerate(levels):
+                for p in level:
+                    print("%4d %s" %(i+1, p))
+            print("%d objects to delete" %len(selected))
+            return
+        counts = {'deleted': 0, 'failed': 0, 'skipped': 0}
+        for wave in waves:
+            for p,status,error in wave:
+                counts[status] += 1
+                if status == 'failed':
+                    print("Failed %s: %s" %(p, error))
+                elif status == 'skipped':
+                    print("Skipped %s" %p)
+        print("Deleted %(deleted)d, failed %(failed)d, skipped %(skipped)d" %counts)
+        return
+
     obj = createNsxObject(objName=args.ns, mp=mp, args=args)
         
     if args.ns == 'lb' and argsNs['lb'] not in ['list', 'find', 'monitoring',
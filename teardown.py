@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+import fnmatch
+from hapi import exportTree
+from desiredstate import localPath, pathReferences, dependencyLevels
+
+# fields holding the object's own path or its parent's, not references
+OWN_PATHS = ('path', 'parent_path', 'relative_path')
+
+class Teardown(object):
+    '''
+    Deletes a set of policy objects, and the objects nested below them,
+    leaves first.  Objects are selected by root path, tag or display_name
+    pattern from one H-API snapshot of infra, which is also used to find
+    the objects referring to them
+    '''
+    def __init__(self, mp, types=None):
+        self.mp = mp
+        self.types = types
+        self.objects = None
+        self.refs = None
+
+    def snapshot(self):
+        '''
+        Current objects by path, and the paths each object refers to
+        '''
+        self.objects = {}
+        self.refs = {}
+        for o in exportTree(mp=self.mp, typeFilter=';'.join(self.types) if self.types
+                            else None, types=self.types):
+            path = localPath(o['path'])
+            self.objects[path] = o
+            self.refs[path] = pathReferences(dict((k,v) for k,v in o.items()
+                                                  if k not in OWN_PATHS))
+        return self.objects
+
+    def matches(self, obj, path, rootPath=None, tag=None, name=None):
+        if rootPath and path != rootPath and not path.startswith(rootPath + '/'):
+            return False
+        if tag:
+            scope, sep, value = tag.rpartition(':')
+            if not any(t.get('tag') == value and (not sep or t.get('scope') == scope)
+                       for t in obj.get('tags', [])):
+                return False
+        if name and not fnmatch.fnmatchcase(obj.get('display_name', ''), name):
+            return False
+        return True
+
+    def select(self, rootPath=None, tag=None, name=None, cascade=False):
+        '''
+        Returns the set of paths to delete: the objects matching all the
+        given criteria and the objects nested below them.  Objects outside
+        the set referring to it are added too if cascade, otherwise
+        ValueError lists them.  System owned objects are never selected
+        '''
+        if not (rootPath or tag or name):
+            raise ValueError("Teardown needs a root path, tag or name pattern")
+        if self.objects is None:
+            self.snapshot()
+        rootPath = localPath(rootPath.rstrip('/')) if rootPath else None
+        roots = [p for p,o in self.objects.items()
+                 if self.matches(o, p, rootPath=rootPath, tag=tag, name=name)]
+        selected = set()
+        for r in roots:
+            selected.update(p for p in self.objects if p == r or p.startswith(r + '/'))
+        selected = set(p for p in selected if not self.systemOwned(self.objects[p]))
+        while True:
+            referrers = set(p for p,refs in self.refs.items()
+                            if p not in selected and refs & selected
+                            and not self.systemOwned(self.objects[p]))
+            if not referrers:
+                return selected
+            if not cascade:
+                raise ValueError("In use by objects outside the teardown: %s"
+                                 % ', '.join(sorted(referrers)))
+            for r in referrers:
+                selected.update(p for p in self.objects if p == r or p.startswith(r + '/'))
+
+    def systemOwned(self, obj):
+        return obj.get('_system_owned') or obj.get('_create_user') == 'system'
+
+    def dependencies(self, selected):
+        '''
+        Maps each selected path to the selected paths that must be deleted
+        before it: the objects referring to it and the ones nested below it.
+        References to an object's own descendants are left out, those go
+        first anyway
+        '''
+        deps = dict((p, set()) for p in selected)
+        for p in selected:
+            for r in self.refs[p] & selected:
+                if r != p and not r.startswith(p + '/'):
+                    deps[r].add(p)
+            parent = p
+            while '/' in parent.strip('/'):
+                parent = parent.rsplit('/', 1)[0]
+                if parent in deps:
+                    deps[parent].add(p)
+        return deps
+
+    def run(self, selected, maxWorkers=8, verbose=False):
+        '''
+        DELETE the selected paths in waves, each wave the objects nothing
+        left depends on, with at most maxWorkers requests in flight.  An
+        object is skipped if something that had to go before it failed.
+        Returns the list of waves, each a list of (path, status, error)
+        '''
+        deps = self.dependencies(selected)
+        status = {}
+        waves = []
+        for level in dependencyLevels(deps):
+            run = [p for p in level if all(status[d] == 'deleted' for d in deps[p])]
+            for p in level:
+                if p not in run:
+                    status[p] = 'skipped'
+            results = self.mp.mapDelete(apis=['/policy/api/v1%s' % p for p in run],
+                                        maxWorkers=maxWorkers, verbose=verbose,
+                                        codes=[200])
+            errors = {}
+            for p,r in zip(run, results):
+                status[p] = 'failed' if isinstance(r, Exception) else 'deleted'
+                if isinstance(r, Exception):
+                    errors[p] = str(r)
+            waves.append([(p, status[p], errors.get(p)) for p in level])
+        return waves